@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""Offline benchmarks for the tick systems and service functions.
+
+Runs calculate_damages, calculate_movements, process_interactions,
+move_direction, a burst of concurrent attacks (p99 latency included), get_info and the instancing
+functions against an in-memory Redis (fakeredis[lua]) and a
+throwaway SQLite file, for every combination of entity count and queue depth,
+plus an encode/decode round of every codec (bytes per message included):
+
+    python benchmark.py --sizes 1000,100000,1000000 --depths 1000,5000
+
+Each run is appended to a JSON-lines history file and compared with the
+previous run of the same benchmark; a drop in ops/sec beyond --threshold is
+reported as a regression (and fails the run with --fail-on-regression).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import fakeredis
+import database
+from spatial import cell_of, cell_key
+from shards import shard_key
+from codec import CODECS, QUEUE_CODEC
+from entities import get_store, drop_store
+from storage import LAYOUT
+
+MAP_INSTANCE = 2
+MAP_SIZE = 512
+WALL_DENSITY = 0.05
+
+def world_side(size: int) -> float:
+    # Constant density (~80 entities in a default view circle) at every size
+    return math.sqrt(size) * 20
+
+async def seed_characters(redis, size: int, instance=1, side=None):
+    """Put `size` online characters in Redis, indexed on the grid"""
+    side = side or world_side(size)
+    rng = random.Random(size)
+    for start in range(0, size, 10_000):
+        pipe = redis.pipeline(transaction=False)
+        for charid in range(start + 1, min(size, start + 10_000) + 1):
+            x, y = rng.uniform(0, side), rng.uniform(0, side)
+            key = f"char:{charid}"
+            pipe.hset(key, mapping=LAYOUT.to_stored({
+                "x": x, "y": y, "health": 10 ** 9, "max_health": 10 ** 9, "instance": instance, "state": "online"
+            }))
+            pipe.sadd(cell_key(instance, *cell_of(x, y)), key)
+        await pipe.execute()
+
+def seed_map_instance():
+    rng = random.Random(0)
+    tiles = MAP_SIZE * MAP_SIZE
+    conn = database.get_sqlite_connection()
+    conn.execute("DELETE FROM instances WHERE instance_id = ?", (MAP_INSTANCE,))
+    conn.execute(
+        "INSERT INTO instances VALUES (?, 'bench', ?, ?, ?, ?, 'bench')",
+        (MAP_INSTANCE, MAP_SIZE, MAP_SIZE, ",".join("0" * tiles),
+         "".join("1" if rng.random() < WALL_DENSITY else "0" for _ in range(tiles)))
+    )
+    conn.commit()
+    conn.close()
+
+def seed_sqlite_world(size: int):
+    conn = database.get_sqlite_connection()
+    conn.execute("DELETE FROM characters WHERE userid = 'npc'")
+    conn.execute("DELETE FROM game_objects")
+    rng = random.Random(size)
+    side = world_side(size)
+    conn.executemany(
+        "INSERT INTO characters (charid, userid, name, x, y, instance) VALUES (?, 'npc', ?, ?, ?, 1)",
+        ((i, f"npc{i}", rng.uniform(0, side), rng.uniform(0, side)) for i in range(1, size + 1))
+    )
+    conn.executemany(
+        "INSERT INTO game_objects (object_id, name, x, y, instance, type) VALUES (?, ?, ?, ?, 1, 'tree')",
+        ((i, f"object{i}", rng.uniform(0, side), rng.uniform(0, side)) for i in range(1, size + 1))
+    )
+    conn.commit()
+    conn.close()
+
+# Each benchmark returns (seconds, operations)
+async def bench_calculate_damages(redis, size, depth):
+    from service import calculate_damages
+    rng = random.Random(depth)
+    pipe = redis.pipeline(transaction=False)
+    for _ in range(depth):
+        pipe.rpush(shard_key(0, "combat_queue"), QUEUE_CODEC.encode("attack", {"attacker": 1, "target": rng.randint(1, size), "time": time.time()}))
+    await pipe.execute()
+    # Steady state: the shard owner has had its entities loaded for a while
+    await get_store(0).load(redis, range(1, size + 1))
+    start = time.perf_counter()
+    await calculate_damages(redis)
+    await get_store(0).replicate(redis)
+    return time.perf_counter() - start, depth
+
+async def bench_calculate_movements(redis, size, depth):
+    from service import calculate_movements
+    movers = min(size, depth)
+    rng = random.Random(depth)
+    await seed_characters(redis, movers, instance=MAP_INSTANCE, side=MAP_SIZE)
+    pipe = redis.pipeline(transaction=False)
+    for charid in range(1, movers + 1):
+        pipe.hset(shard_key(0, "move_intents"), charid, f"{rng.uniform(-3, 3)},{rng.uniform(-3, 3)}")
+    await pipe.execute()
+    await get_store(0).load(redis, range(1, movers + 1), kinds=("char",))
+    start = time.perf_counter()
+    await calculate_movements(redis)
+    await get_store(0).replicate(redis)
+    return time.perf_counter() - start, movers
+
+async def bench_process_interactions(redis, size, depth):
+    """`depth` interactions, five characters racing for every chest"""
+    from service import process_interactions
+    chests = max(1, depth // 5)
+    pipe = redis.pipeline(transaction=False)
+    for object_id in range(1, chests + 1):
+        pipe.hset(f"object:{object_id}", mapping=LAYOUT.to_stored({
+            "x": object_id * 10, "y": 10, "type": "container", "instance": 1, "state": "active"
+        }))
+    for i in range(depth):
+        charid, object_id = i % size + 1, i % chests + 1
+        pipe.hset(f"char:{charid}", mapping=LAYOUT.to_stored({"x": object_id * 10 + 1, "y": 10}))
+        pipe.rpush(shard_key(0, "interaction_queue"), QUEUE_CODEC.encode("interact", {"charid": charid, "object_id": object_id, "time": time.time()}))
+    await pipe.execute()
+    await get_store(0).load(redis, range(1, size + 1), kinds=("char",))
+    start = time.perf_counter()
+    await process_interactions(redis)
+    return time.perf_counter() - start, depth
+
+async def bench_move_direction(redis, size, depth):
+    from service import move_direction
+    rng = random.Random(depth)
+    start = time.perf_counter()
+    for _ in range(depth):
+        await move_direction(rng.randint(1, size), rng.uniform(-1, 1), rng.uniform(-1, 1))
+    return time.perf_counter() - start, depth
+
+async def bench_attack_burst(redis, size, depth):
+    """`depth` attack requests in flight at once, as under a raid"""
+    from service import attack_direction
+    rng = random.Random(depth)
+    latencies = []
+
+    async def attack(charid, target_id):
+        start = time.perf_counter()
+        await attack_direction(charid, target_id)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(attack(rng.randint(1, size), rng.randint(1, size)) for _ in range(depth)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return seconds, depth, {"p99_ms": latencies[int(len(latencies) * 0.99)] * 1000}
+
+async def bench_get_info(redis, size, depth):
+    from service import get_info
+    rng = random.Random(depth)
+    calls = min(depth, 1000)
+    start = time.perf_counter()
+    for _ in range(calls):
+        await get_info(rng.randint(1, size))
+    return time.perf_counter() - start, calls
+
+async def bench_instancing(redis, size, depth):
+    from lib import instance_npcs, instance_objects
+    await asyncio.to_thread(seed_sqlite_world, size)
+    start = time.perf_counter()
+    await instance_npcs()
+    await instance_objects()
+    return time.perf_counter() - start, size * 2
+
+def sample_messages(count: int):
+    """A realistic mix of queue items and events, as (kind, fields)"""
+    rng = random.Random(count)
+    kinds = [
+        ("movement", lambda: {"charid": rng.randint(1, 10 ** 6), "x": rng.uniform(0, 4096), "y": rng.uniform(0, 4096)}),
+        ("attack", lambda: {"attacker": rng.randint(1, 10 ** 6), "target": rng.randint(1, 10 ** 6), "time": time.time()}),
+        ("combat", lambda: {"hits": [
+            {"target": rng.randint(1, 10 ** 6), "target_type": rng.choice(("char", "npc")), "damage": 10 * hits,
+             "new_health": rng.randint(0, 100),
+             "attackers": [{"attacker": rng.randint(1, 10 ** 6), "damage": 10} for _ in range(hits)]}
+            for hits in (rng.randint(1, 3) for _ in range(rng.randint(1, 4)))
+        ]}),
+    ]
+    return [(kind, make()) for kind, make in (rng.choice(kinds) for _ in range(count))]
+
+def codec_bench(name):
+    async def bench(redis, size, depth):
+        codec = CODECS[name]
+        messages = sample_messages(depth)
+        start = time.perf_counter()
+        encoded = [codec.encode(kind, fields) for kind, fields in messages]
+        for (kind, _), data in zip(messages, encoded):
+            codec.decode(kind, data)
+        seconds = time.perf_counter() - start
+        size_bytes = sum(len(data.encode() if isinstance(data, str) else data) for data in encoded)
+        return seconds, depth, {"bytes_per_message": size_bytes / depth}
+    return bench
+
+BENCHMARKS = {
+    "calculate_damages": (bench_calculate_damages, True),
+    "calculate_movements": (bench_calculate_movements, True),
+    "process_interactions": (bench_process_interactions, True),
+    "move_direction": (bench_move_direction, True),
+    "attack_burst": (bench_attack_burst, True),
+    "get_info": (bench_get_info, True),
+    "instancing": (bench_instancing, False),  # does not depend on queue depth
+}
+for _codec in CODECS:  # msgpack only when installed
+    BENCHMARKS[f"codec_{_codec}"] = (codec_bench(_codec), True)
+
+async def run_one(name, size, depth, repeat):
+    bench, uses_depth = BENCHMARKS[name]
+    best = None
+    for _ in range(repeat):
+        # Fresh world for every repetition so runs don't feed into each other
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        database._redis = redis
+        # The undecoded client is rebuilt on the new server's pool
+        database._redis_raw = None
+        drop_store(0)
+        if name not in ("instancing", "calculate_movements") and not name.startswith("codec_"):
+            await seed_characters(redis, size)
+        # Progress output from the code under test stays off the JSON on stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            seconds, ops, *extra = await bench(redis, size, depth)
+        if best is None or seconds < best[0]:
+            best = (seconds, ops, extra[0] if extra else {})
+        await redis.close()
+    seconds, ops, extra = best
+    return {
+        "benchmark": name,
+        "size": size,
+        "depth": depth if uses_depth else None,
+        "seconds": seconds,
+        "ops_per_sec": ops / seconds if seconds else None,
+        **extra,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except Exception:
+        return None
+
+def load_last_results(path):
+    """Latest recorded ops/sec per (benchmark, size, depth)"""
+    last = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                for result in json.loads(line)["results"]:
+                    last[(result["benchmark"], result["size"], result["depth"])] = result["ops_per_sec"]
+    return last
+
+async def main(args):
+    with contextlib.redirect_stdout(sys.stderr):
+        database.init_databases()
+    seed_map_instance()
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    depths = [int(d) for d in args.depths.split(",")]
+
+    previous = load_last_results(args.history)
+    results, regressions = [], []
+    for name in names:
+        uses_depth = BENCHMARKS[name][1]
+        for size in sizes:
+            for depth in (depths if uses_depth else depths[:1]):
+                result = await run_one(name, size, depth, args.repeat)
+                results.append(result)
+                key = (name, size, result["depth"])
+                line = f"{name:20} size={size:<8} depth={str(result['depth']):<6} {result['seconds'] * 1000:10.2f} ms {result['ops_per_sec']:12.0f} ops/s"
+                if "bytes_per_message" in result:
+                    line += f" {result['bytes_per_message']:6.1f} B/msg"
+                if "p99_ms" in result:
+                    line += f"  p99 {result['p99_ms']:.2f} ms"
+                before = previous.get(key)
+                if before and result["ops_per_sec"] < before * (1 - args.threshold):
+                    regressions.append({"benchmark": name, "size": size, "depth": result["depth"],
+                                        "before": before, "after": result["ops_per_sec"]})
+                    line += f"  REGRESSION (was {before:.0f} ops/s)"
+                print(line, file=sys.stderr)
+
+    record = {"timestamp": time.time(), "commit": git_commit(), "results": results}
+    with open(args.history, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(json.dumps({**record, "regressions": regressions}, indent=2))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="entity counts, comma separated")
+    parser.add_argument("--depths", default="1000", help="queue depths / calls per tick, comma separated")
+    parser.add_argument("--only", help="comma separated subset of: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    parser.add_argument("--history", default="bench_history.jsonl")
+    parser.add_argument("--threshold", type=float, default=0.2, help="ops/sec drop counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    regressions = asyncio.run(main(args))
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
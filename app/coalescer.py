@@ -0,0 +1,105 @@
+"""Micro-batching of action scripts across concurrent requests.
+
+Every /move, /attack and /interact request is one script call. Under load,
+thousands of handlers would each make their own round trip on the shared
+connection pool, so calls are instead collected and sent as one pipeline;
+each caller gets its own result, or its own error, back. While a batch is
+in flight, calls are collected for up to ACTION_BATCH_WINDOW seconds (or
+until ACTION_BATCH_MAX are waiting); when Redis is idle they go out right
+away with whatever arrived in the same loop iteration, so a lone request
+doesn't wait for the window. Redis sees one round trip per batch instead
+of one per request.
+
+ACTION_BATCH_WINDOW=0 turns batching off.
+"""
+import asyncio
+import os
+from typing import List, Optional, Sequence, Set, Tuple
+from database import get_redis
+from scripts import run_script
+import metrics
+
+ACTION_BATCH_WINDOW = float(os.getenv("ACTION_BATCH_WINDOW", "0.001"))
+ACTION_BATCH_MAX = int(os.getenv("ACTION_BATCH_MAX", "500"))
+
+class ScriptCoalescer:
+    def __init__(self, window: float = ACTION_BATCH_WINDOW, max_batch: int = ACTION_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        # (script source, keys, args, future of the caller)
+        self._pending: List[Tuple[str, Sequence, Sequence, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Set[asyncio.Task] = set()
+        # Batches sent and not answered yet
+        self._in_flight = 0
+
+    async def run_script(self, source: str, keys: Sequence = (), args: Sequence = ()):
+        """Like scripts.run_script, but sent along with everyone else's calls"""
+        if self.window <= 0:
+            return await run_script(await get_redis(), source, keys=keys, args=args)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((source, keys, args, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window if self._in_flight else 0, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._in_flight += 1
+            task = asyncio.create_task(self._execute(batch))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+    async def _execute(self, batch):
+        metrics.ACTION_BATCH_SIZE.observe(len(batch))
+        redis = await get_redis()
+        try:
+            if len(batch) == 1:
+                # A pipeline would add a SCRIPT EXISTS round trip
+                source, keys, args, _ = batch[0]
+                results = [await run_script(redis, source, keys=keys, args=args)]
+            else:
+                pipe = redis.pipeline(transaction=False)
+                for source, keys, args, _ in batch:
+                    await run_script(pipe, source, keys=keys, args=args)
+                results = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            # Before waking the callers, whose next calls shouldn't wait for us
+            self._in_flight -= 1
+        for (_, _, _, future), result in zip(batch, results):
+            # Callers that gave up (cancelled) have nobody to tell
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """Send whatever is still waiting"""
+        self._flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+_coalescer: Optional[ScriptCoalescer] = None
+
+def get_coalescer() -> ScriptCoalescer:
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = ScriptCoalescer()
+    return _coalescer
+
+async def close_coalescer():
+    global _coalescer
+    if _coalescer is not None:
+        await _coalescer.close()
+        _coalescer = None
@@ -0,0 +1,228 @@
+"""Wire encodings for queue items and events.
+
+Every message kind has a fixed layout (SCHEMAS), so the binary codecs don't
+need to repeat field names:
+
+- ``json``: the original format, text; used by SSE and by default
+- ``struct``: little-endian struct layouts, a movement is 24 bytes instead
+  of ~50; lists are a record count followed by the records
+- ``msgpack``: positional msgpack arrays; needs the optional msgpack package
+
+Kinds without a schema fall back to a self-describing encoding (JSON bytes
+for struct, a msgpack map for msgpack).
+
+QUEUE_CODEC picks the format of queue items, EVENT_CODEC the format of
+events on Redis pubsub; both default to json. Clients pick their own format
+for outbound streams (see negotiate()), whatever the bus uses.
+"""
+import json
+import os
+import struct
+from typing import Dict, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # optional
+    msgpack = None
+
+# kind -> ((field, struct format, enum values or None), ...); a LIST field
+# holds any number of records of the nested schema given in place of enums
+LIST = "*"
+SCHEMAS = {
+    "attack": (("attacker", "q", None), ("target", "q", None), ("time", "d", None)),
+    "interact": (("charid", "q", None), ("object_id", "q", None), ("time", "d", None)),
+    "movement": (("charid", "q", None), ("x", "d", None), ("y", "d", None)),
+    # Every target hit in a region during one tick, see calculate_damages
+    "combat": (
+        ("hits", LIST, (
+            ("target", "q", None), ("target_type", "B", ("char", "npc")),
+            ("damage", "d", None), ("new_health", "d", None),
+            ("attackers", LIST, (("attacker", "q", None), ("damage", "d", None))),
+        )),
+    ),
+    "death": (("target", "q", None), ("target_type", "B", ("char", "npc")), ("killer", "q", None)),
+    # A character who got to an object, or lost it to someone else that tick
+    "interaction": (("charid", "q", None), ("object_id", "q", None), ("result", "B", ("ok", "taken"))),
+}
+
+Payload = Union[str, bytes]
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, kind: str, fields: dict) -> str:
+        return json.dumps(fields, separators=(",", ":"))
+
+    def decode(self, kind: str, data: Payload) -> dict:
+        return json.loads(data)
+
+# Lists are written as a record count followed by the records
+LIST_COUNT = struct.Struct("<H")
+
+class StructLayout:
+    """Struct layout of a schema: runs of fixed fields, and lists between them"""
+    def __init__(self, fields):
+        # ("fixed", Struct, field names, {field: enum values}) or ("list", field, StructLayout)
+        self.parts = []
+        run = []
+        for field in list(fields) + [None]:
+            if field is not None and field[1] != LIST:
+                run.append(field)
+                continue
+            if run:
+                self.parts.append((
+                    "fixed", struct.Struct("<" + "".join(fmt for _, fmt, _ in run)),
+                    [name for name, _, _ in run], {name: values for name, _, values in run if values}
+                ))
+                run = []
+            if field is not None:
+                self.parts.append(("list", field[0], StructLayout(field[2])))
+        # The only part of flat layouts, the common case, which take a shortcut
+        self.flat = self.parts[0] if len(self.parts) == 1 and self.parts[0][0] == "fixed" else None
+
+    def pack(self, fields: dict, out: bytearray):
+        for part in self.parts:
+            if part[0] == "list":
+                _, name, layout = part
+                out += LIST_COUNT.pack(len(fields[name]))
+                for record in fields[name]:
+                    layout.pack(record, out)
+            else:
+                _, packer, names, enums = part
+                out += packer.pack(*(
+                    enums[name].index(fields[name]) if name in enums else fields[name] for name in names
+                ))
+
+    def unpack(self, data: bytes, offset: int = 0) -> Tuple[dict, int]:
+        fields = {}
+        for part in self.parts:
+            if part[0] == "list":
+                _, name, layout = part
+                (count,) = LIST_COUNT.unpack_from(data, offset)
+                offset += LIST_COUNT.size
+                records = fields[name] = []
+                for _ in range(count):
+                    record, offset = layout.unpack(data, offset)
+                    records.append(record)
+            else:
+                _, packer, names, enums = part
+                fields.update(zip(names, packer.unpack_from(data, offset)))
+                offset += packer.size
+                for name, values in enums.items():
+                    fields[name] = values[fields[name]]
+        return fields, offset
+
+class StructCodec:
+    name = "struct"
+    binary = True
+
+    def __init__(self, schemas=SCHEMAS):
+        self._layouts: Dict[str, StructLayout] = {kind: StructLayout(fields) for kind, fields in schemas.items()}
+
+    def encode(self, kind: str, fields: dict) -> bytes:
+        layout = self._layouts.get(kind)
+        if layout is None:
+            return json.dumps(fields, separators=(",", ":")).encode()
+        if layout.flat is not None:
+            _, packer, names, enums = layout.flat
+            return packer.pack(*(
+                enums[name].index(fields[name]) if name in enums else fields[name] for name in names
+            ))
+        out = bytearray()
+        layout.pack(fields, out)
+        return bytes(out)
+
+    def decode(self, kind: str, data: Payload) -> dict:
+        layout = self._layouts.get(kind)
+        if layout is None:
+            return json.loads(data)
+        if layout.flat is not None:
+            _, packer, names, enums = layout.flat
+            fields = dict(zip(names, packer.unpack(data)))
+            for name, values in enums.items():
+                fields[name] = values[fields[name]]
+            return fields
+        fields, size = layout.unpack(data)
+        if size != len(data):
+            raise struct.error(f"{len(data) - size} trailing bytes in {kind}")
+        return fields
+
+def _to_row(schema, fields: dict) -> list:
+    return [[_to_row(nested, record) for record in fields[name]] if fmt == LIST else fields[name]
+            for name, fmt, nested in schema]
+
+def _from_row(schema, row: list) -> dict:
+    return {name: [_from_row(nested, record) for record in value] if fmt == LIST else value
+            for (name, fmt, nested), value in zip(schema, row)}
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def __init__(self, schemas=SCHEMAS):
+        self._schemas = schemas
+
+    def encode(self, kind: str, fields: dict) -> bytes:
+        schema = self._schemas.get(kind)
+        if schema is None:
+            return msgpack.packb(fields)
+        return msgpack.packb(_to_row(schema, fields))
+
+    def decode(self, kind: str, data: Payload) -> dict:
+        value = msgpack.unpackb(data)
+        schema = self._schemas.get(kind)
+        if schema is None or not isinstance(value, list):
+            return value
+        return _from_row(schema, value)
+
+CODECS = {"json": JsonCodec(), "struct": StructCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+def get_codec(name: str):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec {name!r}, expected one of {', '.join(CODECS)}")
+
+def negotiate(offered: Optional[str]):
+    """First codec of a client's comma separated preference list we support"""
+    for name in (offered or "").split(","):
+        codec = CODECS.get(name.strip())
+        if codec is not None:
+            return codec
+    return CODECS["json"]
+
+QUEUE_CODEC = get_codec(os.getenv("QUEUE_CODEC", "json"))
+EVENT_CODEC = get_codec(os.getenv("EVENT_CODEC", "json"))
+
+class Event:
+    """One event off the bus, encoded for each client codec at most once"""
+    __slots__ = ("kind", "data", "_fields", "_encoded")
+
+    def __init__(self, kind: str, data: Payload):
+        self.kind = kind
+        self.data = data.encode() if isinstance(data, str) else data
+        self._fields: Optional[dict] = None
+        self._encoded: Dict[str, Payload] = {}
+
+    @property
+    def fields(self) -> dict:
+        if self._fields is None:
+            self._fields = EVENT_CODEC.decode(self.kind, self.data)
+        return self._fields
+
+    def encode(self, codec) -> Payload:
+        encoded = self._encoded.get(codec.name)
+        if encoded is None:
+            if codec is EVENT_CODEC:
+                # Already in the right format, only JSON needs turning into text
+                encoded = self.data if codec.binary else self.data.decode()
+            else:
+                encoded = codec.encode(self.kind, self.fields)
+            self._encoded[codec.name] = encoded
+        return encoded
+
+    def text(self) -> str:
+        return self.encode(CODECS["json"])
@@ -0,0 +1,147 @@
+"""Decoded collision and height maps, cached in-process per instance.
+
+The instances table stores collision_map as a row-major string of 0s and 1s
+and height_map as comma-separated ints. Parsing those on every move would be
+far too slow, so each instance is decoded once into a packed bitset (one bit
+per tile) and an int array, and kept until invalidated. Tiles are one world
+unit wide; anything outside the x_size/y_size bounds counts as solid.
+"""
+import math
+import numpy as np
+from array import array
+from typing import Dict, Optional
+from database import run_sqlite
+
+class CollisionMap:
+    def __init__(self, x_size: int, y_size: int, collision_map: str, height_map: str):
+        self.x_size = x_size
+        self.y_size = y_size
+
+        # Tiles missing from a short map string are walkable
+        self.bits = bytearray((x_size * y_size + 7) // 8)
+        for i, tile in enumerate(collision_map[:x_size * y_size]):
+            if tile == "1":
+                self.bits[i >> 3] |= 1 << (i & 7)
+
+        self.heights = array("i", bytes(4 * x_size * y_size))
+        for i, h in enumerate(height_map.split(",")[:x_size * y_size]):
+            if h.strip():
+                self.heights[i] = int(h)
+
+    def blocked(self, tx: int, ty: int) -> bool:
+        if not (0 <= tx < self.x_size and 0 <= ty < self.y_size):
+            return True
+        i = ty * self.x_size + tx
+        return bool(self.bits[i >> 3] >> (i & 7) & 1)
+
+    def height(self, x: float, y: float) -> int:
+        tx, ty = math.floor(x), math.floor(y)
+        if not (0 <= tx < self.x_size and 0 <= ty < self.y_size):
+            return 0
+        return self.heights[ty * self.x_size + tx]
+
+    def point_blocked(self, x: float, y: float) -> bool:
+        return self.blocked(math.floor(x), math.floor(y))
+
+    def segment_blocked(self, x0: float, y0: float, x1: float, y1: float) -> bool:
+        """Walk every tile the segment crosses (Amanatides-Woo grid traversal)"""
+        tx, ty = math.floor(x0), math.floor(y0)
+        end_x, end_y = math.floor(x1), math.floor(y1)
+        # The end tile explicitly: with an end on a tile edge, rounding can
+        # stop the walk one tile short of it
+        if self.blocked(tx, ty) or self.blocked(end_x, end_y):
+            return True
+
+        dx, dy = x1 - x0, y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        # Distance along the segment (0..1) to the next vertical/horizontal tile edge
+        t_delta_x = abs(1 / dx) if dx else math.inf
+        t_delta_y = abs(1 / dy) if dy else math.inf
+        t_max_x = ((tx + (step_x > 0)) - x0) / dx if dx else math.inf
+        t_max_y = ((ty + (step_y > 0)) - y0) / dy if dy else math.inf
+
+        while (tx, ty) != (end_x, end_y):
+            if t_max_x < t_max_y:
+                if t_max_x > 1:
+                    break
+                tx += step_x
+                t_max_x += t_delta_x
+            else:
+                if t_max_y > 1:
+                    break
+                ty += step_y
+                t_max_y += t_delta_y
+            if self.blocked(tx, ty):
+                return True
+        return False
+
+    def blocked_many(self, tx: np.ndarray, ty: np.ndarray) -> np.ndarray:
+        """Vectorized blocked() over arrays of tile coordinates"""
+        inside = (tx >= 0) & (tx < self.x_size) & (ty >= 0) & (ty < self.y_size)
+        i = np.where(inside, ty * self.x_size + tx, 0)
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        return ~inside | ((bits[i >> 3] >> (i & 7)) & 1).astype(bool)
+
+    def segments_blocked(self, x0: np.ndarray, y0: np.ndarray, x1: np.ndarray, y1: np.ndarray) -> np.ndarray:
+        """Vectorized segment_blocked() for many movers at once
+
+        The same grid traversal, advancing every path that is still walking
+        by one tile per pass, so a path is blocked exactly when
+        segment_blocked() says so (corners included).
+        """
+        tx, ty = np.floor(x0).astype(np.int64), np.floor(y0).astype(np.int64)
+        end_x, end_y = np.floor(x1).astype(np.int64), np.floor(y1).astype(np.int64)
+        blocked = self.blocked_many(tx, ty) | self.blocked_many(end_x, end_y)
+
+        dx, dy = x1 - x0, y1 - y0
+        step_x = np.where(dx > 0, 1, -1)
+        step_y = np.where(dy > 0, 1, -1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_delta_x = np.where(dx != 0, np.abs(1 / dx), np.inf)
+            t_delta_y = np.where(dy != 0, np.abs(1 / dy), np.inf)
+            t_max_x = np.where(dx != 0, (tx + (step_x > 0) - x0) / dx, np.inf)
+            t_max_y = np.where(dy != 0, (ty + (step_y > 0) - y0) / dy, np.inf)
+
+        active = np.flatnonzero(~blocked & ((tx != end_x) | (ty != end_y)))
+        while active.size:
+            along_x = t_max_x[active] < t_max_y[active]
+            # Paths whose next tile edge lies past their end are done
+            walking = np.where(along_x, t_max_x[active], t_max_y[active]) <= 1
+            active, along_x = active[walking], along_x[walking]
+            sx, sy = active[along_x], active[~along_x]
+            tx[sx] += step_x[sx]
+            t_max_x[sx] += t_delta_x[sx]
+            ty[sy] += step_y[sy]
+            t_max_y[sy] += t_delta_y[sy]
+            blocked[active] = self.blocked_many(tx[active], ty[active])
+            active = active[~blocked[active] & ((tx[active] != end_x[active]) | (ty[active] != end_y[active]))]
+        return blocked
+
+_maps: Dict[str, Optional[CollisionMap]] = {}
+
+def _fetch_instance(conn, instance_id):
+    return conn.execute(
+        "SELECT x_size, y_size, height_map, collision_map FROM instances WHERE instance_id = ?",
+        (instance_id,)
+    ).fetchone()
+
+async def get_collision_map(instance_id) -> Optional[CollisionMap]:
+    """Return the decoded map for an instance, loading it on first use"""
+    key = str(instance_id)
+    if key in _maps:
+        return _maps[key]
+
+    row = await run_sqlite(_fetch_instance, instance_id)
+    collision_map = None
+    if row:
+        collision_map = CollisionMap(row["x_size"], row["y_size"], row["collision_map"], row["height_map"])
+    _maps[key] = collision_map
+    return collision_map
+
+def invalidate_collision_map(instance_id=None):
+    """Drop a cached map (or all of them) so the next lookup reloads it"""
+    if instance_id is None:
+        _maps.clear()
+    else:
+        _maps.pop(str(instance_id), None)
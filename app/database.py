@@ -1,15 +1,66 @@
 import sqlite3
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from redis.asyncio import Redis  # Updated import
 import os
-from typing import Optional
+from typing import Optional, Callable, Any, List
 
 # SQLite connection
 def get_sqlite_connection():
     db_path = os.getenv('DB_PATH', '/data/world.db')
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside the writer; NORMAL sync is safe with WAL
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+# Pooled SQLite access off the event loop. Each worker thread keeps one
+# connection for its lifetime, so the executor doubles as the pool.
+_sqlite_executor: Optional[ThreadPoolExecutor] = None
+_sqlite_local = threading.local()
+_sqlite_connections: List[sqlite3.Connection] = []
+
+def _pooled_connection() -> sqlite3.Connection:
+    conn = getattr(_sqlite_local, "conn", None)
+    if conn is None:
+        conn = get_sqlite_connection()
+        _sqlite_local.conn = conn
+        _sqlite_connections.append(conn)
+    return conn
+
+def _run_pooled(fn: Callable, args) -> Any:
+    conn = _pooled_connection()
+    try:
+        return fn(conn, *args)
+    except BaseException:
+        conn.rollback()
+        raise
+
+async def run_sqlite(fn: Callable, *args) -> Any:
+    """Run fn(conn, *args) on a database worker thread with a pooled connection"""
+    global _sqlite_executor
+    if _sqlite_executor is None:
+        _sqlite_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv('DB_WORKERS', '4')),
+            thread_name_prefix="sqlite"
+        )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_sqlite_executor, _run_pooled, fn, args)
+
+def close_sqlite():
+    global _sqlite_executor
+    if _sqlite_executor is not None:
+        _sqlite_executor.shutdown(wait=True)
+        _sqlite_executor = None
+    for conn in _sqlite_connections:
+        conn.close()
+    _sqlite_connections.clear()
+
 # Redis connection handling
 _redis: Optional[Redis] = None
 
@@ -22,11 +73,27 @@ async def get_redis() -> Redis:
         )
     return _redis
 
+# Same server, but replies stay bytes, for binary payloads (see codec.py)
+_redis_raw: Optional[Redis] = None
+
+async def get_redis_raw() -> Redis:
+    global _redis_raw
+    if _redis_raw is None:
+        pool = (await get_redis()).connection_pool
+        _redis_raw = Redis(connection_pool=pool.__class__(
+            connection_class=pool.connection_class,
+            **dict(pool.connection_kwargs, decode_responses=False)
+        ))
+    return _redis_raw
+
 async def close_redis():
-    global _redis
+    global _redis, _redis_raw
     if _redis is not None:
         await _redis.close()
         _redis = None
+    if _redis_raw is not None:
+        await _redis_raw.close()
+        _redis_raw = None
 
 def init_databases():
     """Initialize both SQLite and Redis databases"""
@@ -67,9 +134,14 @@ def init_databases():
             x REAL,
             y REAL,
             instance INTEGER,
-            type TEXT
+            type TEXT,
+            state TEXT DEFAULT 'active'
         )
     ''')
+    # Databases created before objects had a state
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(game_objects)")]
+    if "state" not in columns:
+        cursor.execute("ALTER TABLE game_objects ADD COLUMN state TEXT DEFAULT 'active'")
 
     print("creating table npcs ...")
     cursor.execute('''
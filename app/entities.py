@@ -0,0 +1,272 @@
+"""In-process entity state of a simulation shard.
+
+Tick systems used to read and write characters and NPCs as Redis hashes,
+parsing x, y and health from strings on every access. The owner of a shard
+keeps them in an EntityStore instead: one dense NumPy column per field (x,
+y, health, max_health, state, instance), row i holding entity ids[i], so a
+system updates whole columns at once. Ids map to rows through an array
+indexed by entity id (characters and NPCs share the charid space). An
+entity costs BYTES_PER_ENTITY bytes here, a fraction of its Redis hash.
+
+The store is authoritative while the shard is owned, and Redis is a replica
+for everyone else (get_info, the API workers, persistence):
+
+- load() pulls entities in from their hashes the first time a system needs
+  them, but only those in the shard's own instances: an entity owned by
+  another shard is that shard's to change;
+- systems mark the rows they change dirty, with what they changed
+  (POSITION, VITALS), and replicate() writes just those fields back at the
+  end of the tick in fenced script calls, adding the entities to the
+  persister's dirty sets;
+- entities whose hash is gone by then (logout, instance eviction) are
+  dropped instead of written back, and so are those whose hash was
+  rewritten from SQLite (a new login) since they were loaded.
+
+Rows only move when entities are dropped, which replicate() does last, so
+rows a system looked up stay valid for the whole tick. A new shard owner
+starts from an empty store and reloads from the replica, which is at most
+a tick behind.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+import numpy as np
+from leader import fence_key, fence_arg
+from scripts import run_script, REPLICATE
+from shards import shard_of
+from storage import LAYOUT, number, stored_fields
+import metrics
+
+KINDS = ("char", "npc")
+# State names by code; states not listed yet get the next code
+STATES: List[str] = ["online", "idle", "dead"]
+# Hash fields an entity is loaded from, in order
+FIELDS = ("x", "y", "health", "max_health", "instance", "state")
+NO_INSTANCE = -1
+# What a system changed, for mark_dirty()
+POSITION = 1  # x, y
+VITALS = 2  # health, state
+
+COLUMNS = {
+    "x": np.float64,
+    "y": np.float64,
+    "health": np.float64,
+    "max_health": np.float64,
+    "instance": np.int32,
+    "state": np.uint8,
+    "kind": np.uint8,
+}
+# Columns plus the id and its slot in the id index
+BYTES_PER_ENTITY = sum(np.dtype(dtype).itemsize for dtype in COLUMNS.values()) + 8 + 4
+
+INITIAL_CAPACITY = 1024
+# Entities written per replication script call
+REPLICATE_CHUNK = 5000
+
+def state_code(name: str) -> int:
+    try:
+        return STATES.index(name)
+    except ValueError:
+        STATES.append(name)
+        return len(STATES) - 1
+
+def _float(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class EntityStore:
+    def __init__(self, shard: int = 0, capacity: int = INITIAL_CAPACITY):
+        self.shard = shard
+        self.size = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        # POSITION | VITALS flags of the fields to write back
+        self.dirty = np.zeros(capacity, dtype=np.uint8)
+        # entity id -> row, -1 when not loaded
+        self._rows = np.full(capacity, -1, dtype=np.int32)
+        self._dropped = set()
+        # Dropped without being written back: their hashes are newer
+        self._forgotten = set()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getattr__(self, name):
+        # store.x, store.health, ...: the live part of a column, writable
+        columns = self.__dict__.get("columns")
+        if columns is not None and name in columns:
+            return columns[name][:self.size]
+        raise AttributeError(name)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory held by the columns and the id index"""
+        return (self.ids.nbytes + self.dirty.nbytes + self._rows.nbytes
+                + sum(column.nbytes for column in self.columns.values()))
+
+    def rows_of(self, ids) -> np.ndarray:
+        """Rows of the given entity ids, -1 for those not loaded"""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        known = (ids >= 0) & (ids < len(self._rows))
+        rows[known] = self._rows[ids[known]]
+        return rows
+
+    def _reserve(self, entity_id: int):
+        if self.size == len(self.ids):
+            capacity = len(self.ids) * 2
+            self.ids = np.resize(self.ids, capacity)
+            self.dirty = np.resize(self.dirty, capacity)
+            for name, column in self.columns.items():
+                self.columns[name] = np.resize(column, capacity)
+        if entity_id >= len(self._rows):
+            index = np.full(max(entity_id + 1, len(self._rows) * 2), -1, dtype=np.int32)
+            index[:len(self._rows)] = self._rows
+            self._rows = index
+
+    def add(self, entity_id: int, kind: str, values: Sequence) -> int:
+        """Insert or overwrite an entity from its hash values (FIELDS order); returns its row"""
+        row = int(self.rows_of([entity_id])[0])
+        if row < 0:
+            self._reserve(entity_id)
+            row = self.size
+            self.size += 1
+            self.ids[row] = entity_id
+            self._rows[entity_id] = row
+        x, y, health, max_health, instance, state = values
+        columns = self.columns
+        columns["x"][row] = _float(x)
+        columns["y"][row] = _float(y)
+        columns["health"][row] = _float(health)
+        columns["max_health"][row] = _float(max_health, columns["health"][row])
+        columns["instance"][row] = int(instance) if instance else NO_INSTANCE
+        columns["state"][row] = state_code(state or "online")
+        columns["kind"][row] = KINDS.index(kind)
+        self.dirty[row] = 0
+        return row
+
+    async def load(self, redis, ids, kinds: Sequence[str] = KINDS) -> np.ndarray:
+        """Rows of the given ids, loading the missing ones from Redis in one
+        pipeline (trying each kind in turn); -1 for entities that don't exist
+        or belong to another shard's instances"""
+        rows = self.rows_of(ids)
+        missing = [entity_id for entity_id in np.unique(np.asarray(ids, dtype=np.int64)[rows < 0]).tolist()
+                   if entity_id >= 0]
+        if not missing:
+            return rows
+
+        pipe = redis.pipeline(transaction=False)
+        for entity_id in missing:
+            for kind in kinds:
+                pipe.hmget(f"{kind}:{entity_id}", *stored_fields(*FIELDS))
+        found = await pipe.execute()
+        for i, entity_id in enumerate(missing):
+            for kind, values in zip(kinds, found[i * len(kinds):(i + 1) * len(kinds)]):
+                if values[0] is not None and values[1] is not None:
+                    if shard_of(values[4]) == self.shard:
+                        self.add(entity_id, kind, values)
+                    break
+        return self.rows_of(ids)
+
+    def mark_dirty(self, rows, fields: int = POSITION | VITALS):
+        self.dirty[rows] |= fields
+
+    def drop_instance(self, instance):
+        """Drop an instance's entities at the next replicate()"""
+        mine = self.instance == int(instance)
+        self._dropped.update(self.ids[:self.size][mine].tolist())
+
+    def forget(self, ids: Iterable[int]):
+        """Drop entities at the next replicate() without writing them back,
+        e.g. a character whose hash a new login rewrote"""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        # Not loaded yet, so nothing stale: the next load reads the new hash
+        self._forgotten.update(ids[self.rows_of(ids) >= 0].tolist())
+
+    def _remove(self, ids: Iterable[int]):
+        # Swap the last row into each hole to keep the columns dense
+        for entity_id in ids:
+            row = int(self.rows_of([entity_id])[0])
+            if row < 0:
+                continue
+            last = self.size - 1
+            if row != last:
+                moved = self.ids[last]
+                self.ids[row] = moved
+                self.dirty[row] = self.dirty[last]
+                for column in self.columns.values():
+                    column[row] = column[last]
+                self._rows[moved] = row
+            self._rows[entity_id] = -1
+            self.size = last
+
+    async def replicate(self, redis, fence: Optional[int] = None, only: Optional[Sequence[int]] = None) -> int:
+        """Write the changed fields of dirty entities (or of just the `only`
+        ones) back to Redis, then apply pending drops if it was all of them.
+        Refused if `fence` is no longer the tick owner's token.
+        Returns the number of entities written."""
+        if only is None:
+            rows = np.flatnonzero(self.dirty[:self.size])
+        else:
+            rows = self.rows_of(only)
+            rows = rows[rows >= 0]
+            rows = rows[self.dirty[rows] != 0]
+        if self._forgotten:
+            rows = rows[~np.isin(self.ids[rows], list(self._forgotten))]
+        written = 0
+        if len(rows):
+            ids = self.ids[rows].tolist()
+            kinds = self.columns["kind"][rows].tolist()
+            x = self.columns["x"][rows].tolist()
+            y = self.columns["y"][rows].tolist()
+            health = self.columns["health"][rows].tolist()
+            states = self.columns["state"][rows].tolist()
+            changed = self.dirty[rows].tolist()
+
+            pipe = redis.pipeline(transaction=False)
+            for start in range(0, len(ids), REPLICATE_CHUNK):
+                args = [fence_arg(fence)]
+                for i in range(start, min(start + REPLICATE_CHUNK, len(ids))):
+                    # Fields nobody changed go as '' and are left alone
+                    args.extend((KINDS[kinds[i]], ids[i]))
+                    if changed[i] & POSITION:
+                        args.extend((LAYOUT.value("x", number(x[i])), LAYOUT.value("y", number(y[i]))))
+                    else:
+                        args.extend(("", ""))
+                    if changed[i] & VITALS:
+                        args.extend((number(health[i]), STATES[states[i]]))
+                    else:
+                        args.extend(("", ""))
+                await run_script(pipe, REPLICATE, keys=[fence_key(self.shard)], args=args)
+            missing = [int(entity_id) for chunk in await pipe.execute() for entity_id in chunk]
+            # Looked up again: with `only`, the tick may have moved or dropped rows meanwhile
+            rows = self.rows_of(ids)
+            kept = rows >= 0
+            self.dirty[rows[kept]] &= ~np.array(changed, dtype=np.uint8)[kept]
+            self._dropped.update(missing)
+            written = len(ids) - len(missing)
+
+        # Rows only move here, at the end of a tick
+        if only is None and (self._dropped or self._forgotten):
+            self._remove(self._dropped | self._forgotten)
+            self._dropped.clear()
+            self._forgotten.clear()
+        metrics.STORE_ENTITIES.set(self.size, self.shard)
+        return written
+
+_stores: Dict[int, EntityStore] = {}
+
+def get_store(shard: int = 0) -> EntityStore:
+    store = _stores.get(shard)
+    if store is None:
+        store = _stores[shard] = EntityStore(shard)
+    return store
+
+def forget_entity(entity_id: int):
+    """Have whichever store holds an entity reload it, skipping its pending changes"""
+    for store in _stores.values():
+        store.forget([entity_id])
+
+def drop_store(shard: int = 0):
+    """Forget a shard's entities, e.g. once its lease is lost"""
+    _stores.pop(shard, None)
@@ -0,0 +1,164 @@
+"""Process-wide fan-out of Redis pubsub events to streaming clients.
+
+Events are published on per-region channels (``{kind}:{instance}:{rx}:{ry}``,
+see spatial.py). A single subscriber task pattern-subscribes to all of them
+and copies every message into bounded asyncio queues, so any number of
+viewers share one Redis connection:
+
+- world clients (``/events``) receive everything;
+- area clients (``/events/{charid}``) only receive events from the 3x3
+  regions around their character, which follow it as it moves.
+
+Queue items are codec.Event objects, shared by every client and encoded
+for each client format at most once. A client whose queue fills up is
+dropped (it gets ``None`` and can reconnect) instead of stalling everyone
+else.
+"""
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+from database import get_redis_raw
+from spatial import regions_around
+from codec import Event
+from metrics import HUB_MESSAGES, HUB_DROPPED_CLIENTS
+
+EVENT_KINDS = ("movement", "combat", "death", "interaction")
+CLIENT_QUEUE_SIZE = 1024
+RECONNECT_DELAY = 1.0
+
+Region = Tuple[str, int, int]
+
+class EventHub:
+    def __init__(self, kinds=EVENT_KINDS, queue_size: int = CLIENT_QUEUE_SIZE):
+        self.kinds = kinds
+        self.queue_size = queue_size
+        self.clients: Set[asyncio.Queue] = set()
+        self.dropped_clients = 0
+        # Area clients, indexed both ways so routing and moves stay cheap
+        self.region_clients: Dict[Region, Set[asyncio.Queue]] = {}
+        self.client_regions: Dict[asyncio.Queue, Tuple[str, list]] = {}
+        self.char_clients: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, redis):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for queue in list(self.clients) + list(self.client_regions):
+            self._close(queue)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Queue receiving every event in the world"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.clients.add(queue)
+        return queue
+
+    def subscribe_area(self, charid, instance, x: float, y: float) -> asyncio.Queue:
+        """Queue receiving only events around a character"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        charid = str(charid)
+        self.char_clients.setdefault(charid, set()).add(queue)
+        self._set_regions(queue, charid, regions_around(instance, x, y))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.clients.discard(queue)
+        if queue in self.client_regions:
+            charid, regions = self.client_regions.pop(queue)
+            for region in regions:
+                self._discard_region(region, queue)
+            watchers = self.char_clients.get(charid)
+            if watchers is not None:
+                watchers.discard(queue)
+                if not watchers:
+                    del self.char_clients[charid]
+
+    def publish_local(self, channel: str, data):
+        """Hand a message to every interested client queue without blocking"""
+        kind, _, region = channel.partition(":")
+        HUB_MESSAGES.inc(kind)
+        event = Event(kind, data)
+        targets = list(self.clients)
+        try:
+            instance, rx, ry = region.split(":")
+            targets.extend(self.region_clients.get((instance, int(rx), int(ry)), ()))
+        except ValueError:
+            instance = None
+
+        # Keep area clients centred on their own character
+        if kind == "movement" and self.char_clients and instance is not None:
+            moved = event.fields
+            for queue in list(self.char_clients.get(str(moved["charid"]), ())):
+                self._set_regions(queue, str(moved["charid"]), regions_around(instance, moved["x"], moved["y"]))
+
+        for queue in targets:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped_clients += 1
+                HUB_DROPPED_CLIENTS.inc()
+                self._close(queue)
+
+    def _set_regions(self, queue: asyncio.Queue, charid: str, regions: list):
+        old = self.client_regions.get(queue)
+        if old is not None and old[1] == regions:
+            return
+        if old is not None:
+            for region in old[1]:
+                self._discard_region(region, queue)
+        for region in regions:
+            self.region_clients.setdefault(region, set()).add(queue)
+        self.client_regions[queue] = (charid, regions)
+
+    def _discard_region(self, region: Region, queue: asyncio.Queue):
+        queues = self.region_clients.get(region)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.region_clients[region]
+
+    def _close(self, queue: asyncio.Queue):
+        # Make room for the end-of-stream marker
+        self.unsubscribe(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def _run(self, redis):
+        while True:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(*(f"{kind}:*" for kind in self.kinds))
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self.publish_local(message["channel"].decode(), message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Event hub lost its subscription: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await pubsub.close()
+
+_hub: Optional[EventHub] = None
+
+async def get_event_hub() -> EventHub:
+    global _hub
+    if _hub is None:
+        _hub = EventHub()
+        # Bytes in, so binary event payloads survive (see codec.py)
+        _hub.start(await get_redis_raw())
+    return _hub
+
+async def close_event_hub():
+    global _hub
+    if _hub is not None:
+        await _hub.stop()
+        _hub = None
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Generate a synthetic world as CSV files for load testing.
+
+Writes accounts.csv, characters.csv, game_objects.csv and instances.csv in
+the same layout as data/pre_data, streaming rows so millions of entities can
+be produced in constant memory. Load them with:
+
+    python generate_world.py --out /tmp/world --players 1000000 --npcs 500000 --objects 1000000
+    DATA_DIR=/tmp/world python populate_db.py
+"""
+import argparse
+import csv
+import random
+from pathlib import Path
+
+OBJECT_TYPES = [
+    ("Ancient Oak", "tree"),
+    ("Granite Boulder", "rock"),
+    ("Treasure Chest", "container"),
+    ("Iron Vein", "ore"),
+]
+WALL_DENSITY = 0.05
+
+def write_instances(path: Path, count: int, size: int, rng: random.Random):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["instance_id", "name", "x_size", "y_size", "height_map", "collision_map", "tags"])
+        for instance_id in range(1, count + 1):
+            tiles = size * size
+            height_map = ",".join(str(rng.randint(0, 9)) for _ in range(tiles))
+            collision_map = "".join("1" if rng.random() < WALL_DENSITY else "0" for _ in range(tiles))
+            writer.writerow([instance_id, f"Instance {instance_id}", size, size, height_map, collision_map, "synthetic"])
+
+def write_accounts(path: Path, players: int):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["userid", "created_at"])
+        writer.writerow(["npc", "2023-01-01 00:00:00"])
+        for i in range(players):
+            writer.writerow([f"player{i}", "2023-01-01 00:00:00"])
+
+def write_characters(path: Path, players: int, npcs: int, instances: int, size: int, rng: random.Random):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["charid", "userid", "name", "x", "y", "health", "max_health", "instance"])
+        for charid in range(1, players + npcs + 1):
+            is_npc = charid > players
+            userid = "npc" if is_npc else f"player{charid - 1}"
+            name = f"{'npc' if is_npc else 'hero'}{charid}"
+            writer.writerow([
+                charid, userid, name,
+                round(rng.uniform(0, size), 2), round(rng.uniform(0, size), 2),
+                100, 100, rng.randint(1, instances)
+            ])
+
+def write_objects(path: Path, objects: int, first_id: int, instances: int, size: int, rng: random.Random):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["object_id", "name", "x", "y", "type", "instance"])
+        for object_id in range(first_id, first_id + objects):
+            name, kind = rng.choice(OBJECT_TYPES)
+            writer.writerow([
+                object_id, name,
+                round(rng.uniform(0, size), 2), round(rng.uniform(0, size), 2),
+                kind, rng.randint(1, instances)
+            ])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", type=Path, required=True, help="directory to write the CSV files to")
+    parser.add_argument("--instances", type=int, default=4)
+    parser.add_argument("--size", type=int, default=512, help="width and height of every instance, in tiles")
+    parser.add_argument("--players", type=int, default=100_000)
+    parser.add_argument("--npcs", type=int, default=50_000)
+    parser.add_argument("--objects", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    args.out.mkdir(parents=True, exist_ok=True)
+    write_instances(args.out / "instances.csv", args.instances, args.size, rng)
+    write_accounts(args.out / "accounts.csv", args.players)
+    write_characters(args.out / "characters.csv", args.players, args.npcs, args.instances, args.size, rng)
+    # Object ids start after the character ids so the two never collide
+    write_objects(args.out / "game_objects.csv", args.objects, args.players + args.npcs + 1, args.instances, args.size, rng)
+    print(f"✅ Wrote {args.players} players, {args.npcs} npcs, {args.objects} objects "
+          f"in {args.instances} instances to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Tick ownership across API processes.
+
+Every uvicorn worker (and every API container) serves HTTP, but each
+simulation shard (see shards.py) may be ticked by only one of them;
+otherwise several would drain the same queues and ticks would be applied
+more than once. For every shard, processes compete for a lease in Redis
+(``{shard:n}:tick:lease``, expiring after LEASE_TTL) and the holder renews
+it every RENEW_INTERVAL. Whoever takes a lease also gets a new fencing token
+(``{shard:n}:tick:fence`` is incremented), and the tick systems pass that
+token to the scripts that drain the shard's queues, which refuse anything
+but the latest one. A holder that stalled past its lease can therefore not
+apply a tick after someone else took over.
+
+A process already owning k shards only goes for a free one every k+1
+rounds, so shards spread over the processes instead of piling up on the
+first one to start.
+
+Failover takes at most LEASE_TTL + RENEW_INTERVAL when an owner dies, and
+RENEW_INTERVAL when it shuts down cleanly and releases its leases.
+"""
+import asyncio
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+from database import get_redis
+from scripts import run_script, ACQUIRE_LEASE, RENEW_LEASE, RELEASE_LEASE
+from shards import SIM_SHARDS, shard_key
+import metrics
+
+LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "3.0"))
+RENEW_INTERVAL = LEASE_TTL / 3
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def lease_key(shard: int) -> str:
+    return shard_key(shard, "tick:lease")
+
+def fence_key(shard: int) -> str:
+    return shard_key(shard, "tick:fence")
+
+def fence_arg(fence: Optional[int]):
+    """A fencing token as script argument; '' runs unfenced"""
+    return fence if fence is not None else ""
+
+class LeaderElection:
+    def __init__(self, on_elected: Callable[[int, int], Awaitable], shard: int = 0, node_id: str = NODE_ID,
+                 ttl: float = LEASE_TTL, held: Callable[[], int] = lambda: 0,
+                 campaign_lock: Optional[asyncio.Lock] = None):
+        """on_elected(shard, token) runs for as long as this process holds the
+        shard's lease; held() is how many shards this process already owns"""
+        self.on_elected = on_elected
+        self.shard = shard
+        self.node_id = node_id
+        self.ttl = ttl
+        self.held = held
+        # Shared by a process's elections so each sees the others' wins
+        self.campaign_lock = campaign_lock or asyncio.Lock()
+        self.token: Optional[int] = None
+        self._rounds = 0
+        self._work: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        metrics.TICK_LEADER.set(0, shard)
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None
+
+    @property
+    def lease_value(self) -> str:
+        return f"{self.node_id}:{self.token}"
+
+    def start(self, redis):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis))
+
+    async def stop(self, redis):
+        """Stop campaigning and hand the lease over right away"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._step_down(redis, release=True)
+
+    async def _step_down(self, redis, release: bool):
+        if self._work is not None:
+            self._work.cancel()
+            await asyncio.gather(self._work, return_exceptions=True)
+            self._work = None
+        if self.token is not None and release:
+            await run_script(redis, RELEASE_LEASE, keys=[lease_key(self.shard)], args=[self.lease_value])
+        self.token = None
+        metrics.TICK_LEADER.set(0, self.shard)
+
+    async def _campaign(self, redis):
+        ttl_ms = int(self.ttl * 1000)
+        if self.token is None:
+            self._rounds += 1
+            if self._rounds % (self.held() + 1):
+                return
+            token = await run_script(
+                redis, ACQUIRE_LEASE, keys=[lease_key(self.shard), fence_key(self.shard)], args=[self.node_id, ttl_ms]
+            )
+            if token:
+                self.token = int(token)
+                metrics.TICK_LEADER.set(1, self.shard)
+                metrics.LEADER_ELECTIONS.inc(self.shard)
+                print(f"Took tick ownership of shard {self.shard} as {self.node_id} (token {self.token})")
+                self._work = asyncio.create_task(self.on_elected(self.shard, self.token))
+            return
+
+        if self._work is not None and self._work.done():
+            # The simulation crashed; let someone else (or us, afresh) take over
+            print(f"Simulation stopped: {self._work.exception() if not self._work.cancelled() else 'cancelled'}")
+            await self._step_down(redis, release=True)
+            return
+        if not await run_script(redis, RENEW_LEASE, keys=[lease_key(self.shard)], args=[self.lease_value, ttl_ms]):
+            print(f"Lost tick ownership of shard {self.shard} (token {self.token})")
+            metrics.LEADERSHIP_LOST.inc(self.shard)
+            await self._step_down(redis, release=False)
+
+    async def _run(self, redis):
+        while True:
+            try:
+                async with self.campaign_lock:
+                    await self._campaign(redis)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Can't renew, so assume the lease will lapse
+                print(f"Leader election failed: {e}")
+                if self.token is not None:
+                    metrics.LEADERSHIP_LOST.inc(self.shard)
+                    await self._step_down(redis, release=False)
+            await asyncio.sleep(RENEW_INTERVAL)
+
+_elections: Dict[int, LeaderElection] = {}
+
+def owned_shards() -> int:
+    return sum(election.is_leader for election in _elections.values())
+
+def owns_shard(shard: int) -> bool:
+    """Whether this process currently holds the shard's lease"""
+    election = _elections.get(shard)
+    return election is not None and election.is_leader
+
+async def start_elections(on_elected: Callable[[int, int], Awaitable]) -> Dict[int, LeaderElection]:
+    """Campaign for every shard; on_elected(shard, token) runs for each one won"""
+    if not _elections:
+        redis = await get_redis()
+        lock = asyncio.Lock()
+        for shard in range(SIM_SHARDS):
+            _elections[shard] = LeaderElection(on_elected, shard, held=owned_shards, campaign_lock=lock)
+            _elections[shard].start(redis)
+    return _elections
+
+async def stop_elections():
+    if _elections:
+        redis = await get_redis()
+        for election in _elections.values():
+            await election.stop(redis)
+        _elections.clear()
@@ -1,61 +1,113 @@
-from database import get_sqlite_connection, get_redis
+from database import run_sqlite, get_redis
+from spatial import place_entity, cell_of, cell_key
+from persistence import get_persister
+from collision import invalidate_collision_map
+from shards import instance_key, shard_of
+from entities import get_store, forget_entity
+from storage import LAYOUT, get_position
+from scripts import run_script, EVICT_INSTANCE
 from typing import Optional, Dict, Any
+import asyncio
+import os
 import sqlite3
+import time
 
 # Account Tools
+# SQLite work runs on the database threads (see database.run_sqlite) so disk
+# I/O never blocks the event loop or the game tick.
+def _insert_account(conn: sqlite3.Connection, userid: str):
+    conn.execute("INSERT INTO accounts (userid) VALUES (?)", (userid,))
+    conn.commit()
+
+def _insert_character(conn: sqlite3.Connection, userid: str, charname: str, instance, x: float, y: float) -> int:
+    cursor = conn.execute(
+        "INSERT INTO characters (userid, name, instance, x, y) VALUES (?, ?, ?, ?, ?)",
+        (userid, charname, instance, x, y)
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+def _fetch_all(conn: sqlite3.Connection, query: str, params=()) -> list:
+    return conn.execute(query, params).fetchall()
+
 async def create_account(userid: str) -> bool:
-    conn = get_sqlite_connection()
     try:
-        conn.execute("INSERT INTO accounts (userid) VALUES (?)", (userid,))
-        conn.commit()
+        await run_sqlite(_insert_account, userid)
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
-async def create_character(userid: str, charname: str) -> Optional[int]:
-    conn = get_sqlite_connection()
+async def create_character(userid: str, charname: str, instance: Optional[int] = None, x: float = 0.0, y: float = 0.0) -> Optional[int]:
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO characters (userid, name) VALUES (?, ?)",
-            (userid, charname)
-        )
-        charid = cursor.lastrowid
-        conn.commit()
-        return charid
+        return await run_sqlite(_insert_character, userid, charname, instance, x, y)
     except sqlite3.IntegrityError:
         return None
-    finally:
-        conn.close()
 
         
 # Instancing Tools
 async def log_in(charid: int) -> bool:
-    conn = get_sqlite_connection()
     redis = await get_redis()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM characters WHERE charid = ?", (charid,))
-        char_data = cursor.fetchone()
-        
-        if not char_data:
-            return False
-        
-        # Store in Redis
-        char_key = f"char:{charid}"
-        await redis.hmset(char_key, {
-            "x": char_data["x"],
-            "y": char_data["y"],
-            "health": char_data["health"],
-            "max_health": char_data["max_health"],
-            "state": "online"
-        })
-        await redis.sadd("online_chars", charid)
-        return True
-    finally:
-        conn.close()
+    rows = await run_sqlite(_fetch_all, "SELECT * FROM characters WHERE charid = ?", (charid,))
+    if not rows:
+        return False
+    char_data = rows[0]
+    instance = char_data["instance"]
+
+    # The instance is materialized by its first player
+    if instance is not None:
+        await load_instance(instance)
+    
+    # A row left from before in a simulation store would otherwise
+    # overwrite what is placed here with its own position and health
+    forget_entity(charid)
+
+    # Store in Redis and index on the instance grid, and count as a player
+    # in the same step so eviction sees either none of it or all of it
+    char_key = f"char:{charid}"
+    pipe = redis.pipeline(transaction=True)
+    await place_entity(pipe, char_key, {
+        "x": char_data["x"],
+        "y": char_data["y"],
+        "health": char_data["health"],
+        "max_health": char_data["max_health"],
+        "instance": instance if instance is not None else "",
+        "state": "online"
+    })
+    if LAYOUT.membership_sets:
+        pipe.sadd("online_chars", charid)
+    if instance is not None:
+        pipe.sadd(instance_key(instance, "players"), charid)
+        pipe.delete(instance_key(instance, "empty_since"))
+    await pipe.execute()
+
+    # The instance may have been evicted between loading it and placing the
+    # character, before it counted as a player; then it is loaded again
+    if instance is not None:
+        await load_instance(instance)
+    return True
+
+async def log_out(charid: int) -> bool:
+    """Persist a character and take it out of the live world"""
+    redis = await get_redis()
+    char_key = f"char:{charid}"
+    x, y, instance = await get_position(redis, char_key)
+    if x is None or y is None:
+        return False
+
+    # This tick's changes to the character go to its hash first, to be persisted too
+    await get_store(shard_of(instance)).replicate(redis, only=[charid])
+    persister = await get_persister()
+    await persister.flush_entity(redis, "char", charid)
+
+    pipe = redis.pipeline(transaction=False)
+    if instance:
+        pipe.srem(cell_key(instance, *cell_of(float(x), float(y))), char_key)
+        pipe.srem(instance_key(instance, "players"), charid)
+    if LAYOUT.membership_sets:
+        pipe.srem("online_chars", charid)
+    pipe.delete(char_key)
+    await pipe.execute()
+    return True
 
 async def instance_world():
     """Load world state from SQLite to Redis"""
@@ -67,51 +119,192 @@ async def instance_creatures():
     redis = await get_redis()
     await redis.set("creatures:instanced", "true")
 
-async def instance_npcs():
-    """Load NPCs from SQLite to Redis"""
-    conn = get_sqlite_connection()
+# Rows are streamed out of SQLite in keyset-paginated chunks and written
+# through one pipeline per chunk; the next chunk is read while the previous
+# one is being written.
+INSTANCE_CHUNK_SIZE = 5000
+
+def _fetch_chunk(conn: sqlite3.Connection, query: str, params: tuple, after: int, limit: int) -> list:
+    return conn.execute(query, (*params, after, limit)).fetchall()
+
+async def _instance_rows(redis, label: str, query: str, params: tuple, id_column: str, prefix: str, set_keys, fields) -> int:
+    start = time.perf_counter()
+    total = 0
+    chunk = await run_sqlite(_fetch_chunk, query, params, -1, INSTANCE_CHUNK_SIZE)
+    while chunk:
+        pipe = redis.pipeline(transaction=False)
+        for row in chunk:
+            await place_entity(pipe, f"{prefix}:{row[id_column]}", fields(row))
+        for set_key in set_keys:
+            pipe.sadd(set_key, *(row[id_column] for row in chunk))
+
+        written = len(chunk)
+        if written == INSTANCE_CHUNK_SIZE:
+            last_id = chunk[-1][id_column]
+            _, chunk = await asyncio.gather(
+                pipe.execute(),
+                run_sqlite(_fetch_chunk, query, params, last_id, INSTANCE_CHUNK_SIZE)
+            )
+        else:
+            await pipe.execute()
+            chunk = []
+        total += written
+
+        elapsed = time.perf_counter() - start
+        print(f"instanced {total} {label} ({total / max(elapsed, 1e-9):.0f}/s)")
+    return total
+
+async def instance_npcs(instance_id=None):
+    """Load NPCs from SQLite to Redis, for one instance or the whole world"""
     redis = await get_redis()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT charid, name, x, y, health, max_health FROM characters WHERE userid = 'npc'")
-        
-        for npc in cursor.fetchall():
-            npc_key = f"npc:{npc['charid']}"
-            await redis.hmset(npc_key, {
-                "name": npc["name"],
-                "x": npc["x"],
-                "y": npc["y"],
-                "health": npc["health"],
-                "max_health": npc["max_health"],
-                "state": "idle"
-            })
-            await redis.sadd("npcs", npc["charid"])
-        
+    where, params, set_keys = "", (), ["npcs"] if LAYOUT.membership_sets else []
+    if instance_id is not None:
+        where, params = "AND instance = ? ", (instance_id,)
+        set_keys.append(instance_key(instance_id, "npcs"))
+    await _instance_rows(
+        redis, "npcs",
+        "SELECT charid, name, x, y, health, max_health, instance FROM characters "
+        f"WHERE userid = 'npc' {where}AND charid > ? ORDER BY charid LIMIT ?",
+        params, "charid", "npc", set_keys,
+        lambda npc: {
+            "name": npc["name"],
+            "x": npc["x"],
+            "y": npc["y"],
+            "health": npc["health"],
+            "max_health": npc["max_health"],
+            "instance": npc["instance"] if npc["instance"] is not None else "",
+            "state": "idle"
+        }
+    )
+    if instance_id is None:
         await redis.set("npcs:instanced", "true")
-        return True
-    finally:
-        conn.close()
+    return True
 
-async def instance_objects():
-    """Load game objects from SQLite to Redis"""
-    conn = get_sqlite_connection()
+async def instance_objects(instance_id=None):
+    """Load game objects from SQLite to Redis, for one instance or the whole world"""
     redis = await get_redis()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT object_id, name, x, y, type FROM game_objects")
-        
-        for obj in cursor.fetchall():
-            obj_key = f"object:{obj['object_id']}"
-            await redis.hmset(obj_key, {
-                "name": obj["name"],
-                "x": obj["x"],
-                "y": obj["y"],
-                "type": obj["type"],
-                "state": "active"
-            })
-            await redis.sadd("world_objects", obj["object_id"])
-        
+    where, params, set_keys = "", (), ["world_objects"] if LAYOUT.membership_sets else []
+    if instance_id is not None:
+        where, params = "instance = ? AND ", (instance_id,)
+        set_keys.append(instance_key(instance_id, "objects"))
+    await _instance_rows(
+        redis, "objects",
+        "SELECT object_id, name, x, y, type, instance, state FROM game_objects "
+        f"WHERE {where}object_id > ? ORDER BY object_id LIMIT ?",
+        params, "object_id", "object", set_keys,
+        lambda obj: {
+            "name": obj["name"],
+            "x": obj["x"],
+            "y": obj["y"],
+            "type": obj["type"],
+            "instance": obj["instance"] if obj["instance"] is not None else "",
+            "state": obj["state"] or "active"
+        }
+    )
+    if instance_id is None:
         await redis.set("objects:instanced", "true")
+    return True
+
+# Instance Lifecycle
+# An instance (its row, NPCs and objects) lives in Redis only while players
+# are in it: the first login loads it, and it is persisted and evicted once
+# it has been empty for INSTANCE_IDLE_TIMEOUT seconds. Eviction checks for
+# players and deletes in one script, so it is safe across workers; the
+# locks only keep a process from loading the same instance twice at once
+# (loading is idempotent, so two workers doing it is merely wasted work).
+INSTANCE_IDLE_TIMEOUT = float(os.getenv('INSTANCE_IDLE_TIMEOUT', '300'))
+EVICTION_CHECK_INTERVAL = float(os.getenv('EVICTION_CHECK_INTERVAL', '30'))
+
+_instance_locks: Dict[str, asyncio.Lock] = {}
+
+async def load_instance(instance_id) -> bool:
+    """Materialize an instance in Redis unless it is already loaded"""
+    redis = await get_redis()
+    key = str(instance_id)
+    if await redis.sismember("loaded_instances", key):
+        return True
+
+    async with _instance_locks.setdefault(key, asyncio.Lock()):
+        if await redis.sismember("loaded_instances", key):
+            return True
+        rows = await run_sqlite(_fetch_all, "SELECT name, x_size, y_size, tags FROM instances WHERE instance_id = ?", (instance_id,))
+        if rows:
+            await redis.hset(instance_key(key), mapping={
+                "name": rows[0]["name"],
+                "x_size": rows[0]["x_size"],
+                "y_size": rows[0]["y_size"],
+                "tags": rows[0]["tags"]
+            })
+        await instance_npcs(instance_id)
+        await instance_objects(instance_id)
+        await redis.sadd("loaded_instances", key)
+        print(f"loaded instance {key}")
         return True
-    finally:
-        conn.close()
+
+async def evict_instance(instance_id) -> bool:
+    """Persist and drop an instance that has no players left"""
+    redis = await get_redis()
+    key = str(instance_id)
+    async with _instance_locks.setdefault(key, asyncio.Lock()):
+        if await redis.scard(instance_key(key, "players")) > 0:
+            return False
+
+        persister = await get_persister()
+        await persister.flush(redis)
+
+        # Only NPCs and objects are in the cells while nobody is playing, and
+        # a login placing someone in a new one makes the script back off
+        cells = [cell async for cell in redis.scan_iter(match=instance_key(key, "cell:*"), count=1000)]
+        evicted = await run_script(redis, EVICT_INSTANCE, keys=[
+            instance_key(key, "players"),
+            instance_key(key, "npcs"),
+            instance_key(key, "objects"),
+            instance_key(key),
+            instance_key(key, "empty_since"),
+            *cells
+        ], args=[key, 1 if LAYOUT.membership_sets else 0])
+        if evicted is None:
+            return False
+        invalidate_collision_map(key)
+        print(f"evicted instance {key} ({evicted[0]} npcs, {evicted[1]} objects)")
+        return True
+
+async def evict_idle_instances(shard: Optional[int] = None) -> list:
+    """Start the idle clock on empty instances and evict those past the timeout
+
+    Only looks at the instances of one shard when given.
+    """
+    redis = await get_redis()
+    loaded = [key for key in await redis.smembers("loaded_instances") if shard is None or shard_of(key) == shard]
+    if not loaded:
+        return []
+
+    pipe = redis.pipeline(transaction=False)
+    for key in loaded:
+        pipe.scard(instance_key(key, "players"))
+        pipe.get(instance_key(key, "empty_since"))
+    results = await pipe.execute()
+
+    now = time.time()
+    evicted = []
+    for key, players, empty_since in zip(loaded, results[::2], results[1::2]):
+        if players:
+            continue
+        if empty_since is None:
+            await redis.set(instance_key(key, "empty_since"), now, nx=True)
+        elif now - float(empty_since) >= INSTANCE_IDLE_TIMEOUT:
+            if await evict_instance(key):
+                evicted.append(key)
+    return evicted
+
+async def instance_evictor(shard: Optional[int] = None):
+    """Periodically evict idle instances (and forget their entities when
+    run by the shard's owner)"""
+    while True:
+        await asyncio.sleep(EVICTION_CHECK_INTERVAL)
+        try:
+            for key in await evict_idle_instances(shard):
+                if shard is not None:
+                    get_store(shard).drop_instance(key)
+        except Exception as e:
+            print(f"Instance eviction failed: {e}")
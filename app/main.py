@@ -1,11 +1,20 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-import asyncio
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from lib import *
 from service import *
-from database import init_databases, get_redis
+from database import init_databases, get_redis, close_sqlite
+from events import get_event_hub, close_event_hub
+from session import run_session
+from persistence import get_persister, close_persister
+import metrics
+from leader import start_elections, stop_elections, owns_shard, lease_key, NODE_ID
+from simulation import run_shard, RUN_SIMULATION
+from shards import SIM_SHARDS
+from storage import get_position
+from coalescer import close_coalescer
 import time
+from typing import Optional
 
 app = FastAPI()
 
@@ -20,25 +29,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-request latency, so endpoints can be compared under the same load
+@app.middleware("http")
+async def add_process_time_header(request, call_next):
+    start_time = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start_time
+    response.headers["X-Process-Time"] = f"{elapsed * 1000:.3f}ms"
+    # Labelled by route template (/move/{charid}), not by raw path
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.HTTP_REQUEST_SECONDS.observe(elapsed, request.method, route, response.status_code)
+    return response
+
 @app.on_event("startup")
 async def startup_event():
-    # Initialize game world
+    # Initialize game world; instances themselves load on first login
     await instance_world()
     await instance_creatures()
-    await instance_npcs()
-    await instance_objects()
     
-    # Start game loop
-    asyncio.create_task(game_loop())
+    # Shared pubsub subscriber for all /events clients
+    await get_event_hub()
 
-async def game_loop():
-    """Run game ticks every 0.6 seconds"""
-    redis = await get_redis()
-    while True:
-        start_time = time.time()
-        await calculate_damages(redis)
-        processing_time = time.time() - start_time
-        await asyncio.sleep(max(0, 0.6 - processing_time))
+    # Periodic write-behind of live state to SQLite
+    await get_persister()
+
+    # Every worker serves requests; each shard is simulated by the one
+    # process elected for it
+    if RUN_SIMULATION:
+        await start_elections(run_shard)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await stop_elections()
+    await close_coalescer()
+    await close_event_hub()
+    await close_persister()
+    close_sqlite()
 
 # Account Endpoints
 @app.post("/account/{userid}")
@@ -48,8 +74,8 @@ async def create_account_endpoint(userid: str):
     raise HTTPException(status_code=400, detail="Account already exists")
 
 @app.post("/character")
-async def create_character_endpoint(userid: str, charname: str):
-    charid = await create_character(userid, charname)
+async def create_character_endpoint(userid: str, charname: str, instance: Optional[int] = None, x: float = 0.0, y: float = 0.0):
+    charid = await create_character(userid, charname, instance, x, y)
     if charid:
         return {"charid": charid}
     raise HTTPException(status_code=400, detail="Character creation failed")
@@ -61,6 +87,12 @@ async def login_endpoint(charid: int):
         return {"message": "Logged in"}
     raise HTTPException(status_code=404, detail="Character not found")
 
+@app.post("/logout/{charid}")
+async def logout_endpoint(charid: int):
+    if await log_out(charid):
+        return {"message": "Logged out"}
+    raise HTTPException(status_code=404, detail="Character not online")
+
 @app.post("/move/{charid}")
 async def move_character_endpoint(charid: int, dx: float, dy: float):
     if await move_direction(charid, dx, dy):
@@ -80,26 +112,76 @@ async def interact_object_endpoint(charid: int, object_id: int):
     raise HTTPException(status_code=404, detail="Character or object not found")
 
 @app.post("/get_info/{charid}/")
-async def get_info_endpoint(charid: int, players: List[int], monsters: List[int], npcs: List[int], items: List[int]):
-    r = await get_info(charid, players, monsters, npcs, items):
+async def get_info_endpoint(charid: int, radius: float = DEFAULT_VIEW_RADIUS):
+    r = await get_info(charid, radius)
+    if not r["status"]:
+        raise HTTPException(status_code=404, detail=r["message"])
     return r
 
+@app.get("/persistence")
+async def persistence_stats():
+    """Write-behind flush lag and batch sizes"""
+    persister = await get_persister()
+    return persister.stats
+
+@app.get("/leader")
+async def leader_status():
+    """Which process currently owns each simulation shard"""
+    redis = await get_redis()
+    leases = await redis.mget([lease_key(shard) for shard in range(SIM_SHARDS)])
+    return {
+        "node": NODE_ID,
+        "shards": {
+            shard: {"lease": lease, "owned": owns_shard(shard)}
+            for shard, lease in enumerate(leases)
+        }
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Tick, event and request metrics for Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Real-time Events
-@app.get("/events")
-async def game_events():
+def sse_stream(hub, queue):
     async def event_stream():
-        redis = await get_redis()
-        pubsub = redis.pubsub()
-        await pubsub.subscribe("movement", "combat", "death", "interaction")
-        
         try:
             while True:
-                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-                if message is not None:
-                    yield f"data: {message['data']}\n\n"
-                await asyncio.sleep(0.1)
-        except asyncio.CancelledError:
-            await pubsub.unsubscribe()
-            await pubsub.close()
+                item = await queue.get()
+                if item is None:  # Dropped for falling behind
+                    break
+                # Flush whatever else is already waiting in the same chunk
+                chunk = []
+                while item is not None:
+                    chunk.append(f"event: {item.kind}\ndata: {item.text()}\n\n")
+                    if queue.empty():
+                        break
+                    item = queue.get_nowait()
+                yield "".join(chunk)
+                if item is None:
+                    break
+        finally:
+            hub.unsubscribe(queue)
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/events")
+async def game_events():
+    hub = await get_event_hub()
+    return sse_stream(hub, hub.subscribe())
+
+@app.get("/events/{charid}")
+async def character_events(charid: int):
+    """Only the events within the character's instance and area of interest"""
+    redis = await get_redis()
+    x, y, instance = await get_position(redis, f"char:{charid}")
+    if x is None or y is None:
+        raise HTTPException(status_code=404, detail="Character not found")
+    hub = await get_event_hub()
+    return sse_stream(hub, hub.subscribe_area(charid, instance or "", float(x), float(y)))
+
+# Game session transport
+@app.websocket("/ws/{charid}")
+async def game_session(websocket: WebSocket, charid: int, codec: Optional[str] = None):
+    """codec: comma separated preference list for event frames, e.g. struct,json"""
+    await run_session(websocket, charid, codec)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Redis memory per entity in each storage layout (see storage.py).
+
+Writes sample NPCs and objects, shaped like the generated world, in every
+layout under a scratch prefix of the configured Redis, measures them with
+MEMORY USAGE (membership sets included) and deletes them again:
+
+    python memory_report.py --entities 100000
+
+Servers without the MEMORY command (fakeredis) only get the payload bytes,
+field names plus values.
+"""
+import argparse
+import asyncio
+import random
+from redis.exceptions import ResponseError
+from database import get_redis
+from entities import BYTES_PER_ENTITY
+from storage import LAYOUTS
+
+BATCH_SIZE = 5000
+
+def sample_entities(count: int):
+    """(kind, id, record) like instance_npcs/instance_objects write them"""
+    rng = random.Random(count)
+    for entity_id in range(1, count + 1):
+        yield "npc", entity_id, {
+            "name": f"npc{entity_id}",
+            "x": rng.uniform(0, 4096),
+            "y": rng.uniform(0, 4096),
+            "health": 100,
+            "max_health": 100,
+            "instance": rng.randint(1, 50),
+            "state": "idle"
+        }
+        yield "object", entity_id, {
+            "name": f"object{entity_id}",
+            "x": rng.uniform(0, 4096),
+            "y": rng.uniform(0, 4096),
+            "type": "tree",
+            "instance": rng.randint(1, 50),
+            "state": "active"
+        }
+
+async def measure(redis, layout, count: int):
+    """Bytes per entity by kind, and whether MEMORY USAGE was available"""
+    prefix = f"memreport:{layout.name}"
+    sets = {"npc": f"{prefix}:npcs", "object": f"{prefix}:world_objects"}
+    keys = {"npc": [], "object": []}
+    payload = {"npc": 0, "object": 0}
+
+    entities = list(sample_entities(count))
+    for start in range(0, len(entities), BATCH_SIZE):
+        pipe = redis.pipeline(transaction=False)
+        for kind, entity_id, record in entities[start:start + BATCH_SIZE]:
+            key = f"{prefix}:{kind}:{entity_id}"
+            stored = layout.to_stored(record)
+            pipe.hset(key, mapping=stored)
+            if layout.membership_sets:
+                pipe.sadd(sets[kind], entity_id)
+            keys[kind].append(key)
+            payload[kind] += sum(len(str(field)) + len(str(value)) for field, value in stored.items())
+        await pipe.execute()
+
+    try:
+        usage = {}
+        for kind, kind_keys in keys.items():
+            total = 0
+            for start in range(0, len(kind_keys), BATCH_SIZE):
+                pipe = redis.pipeline(transaction=False)
+                for key in kind_keys[start:start + BATCH_SIZE]:
+                    pipe.memory_usage(key)
+                total += sum(await pipe.execute())
+            if layout.membership_sets:
+                total += await redis.memory_usage(sets[kind], samples=0) or 0
+            usage[kind] = total / count
+        measured = True
+    except ResponseError:
+        usage = {kind: size / count for kind, size in payload.items()}
+        measured = False
+    finally:
+        for kind_keys in keys.values():
+            for start in range(0, len(kind_keys), BATCH_SIZE):
+                await redis.delete(*kind_keys[start:start + BATCH_SIZE])
+        await redis.delete(*sets.values())
+    return usage, measured
+
+async def main(args):
+    redis = await get_redis()
+    try:
+        results = {}
+        for name, layout in LAYOUTS.items():
+            results[name] = await measure(redis, layout, args.entities)
+        baseline = results["hash"][0]
+        for name, (usage, measured) in results.items():
+            what = "bytes/entity" if measured else "payload bytes/entity (no MEMORY command)"
+            line = "  ".join(
+                f"{kind} {size:7.1f} ({size / baseline[kind]:4.0%})" for kind, size in usage.items()
+            )
+            print(f"{name:8} {what}: {line}")
+        print(f"in-process shard store: {BYTES_PER_ENTITY} bytes/entity")
+    finally:
+        await redis.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entities", type=int, default=10000, help="NPCs and objects written per layout")
+    asyncio.run(main(parser.parse_args()))
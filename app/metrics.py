@@ -0,0 +1,175 @@
+"""In-process metrics, exposed in the Prometheus text format at /metrics.
+
+Counters, gauges and fixed-bucket histograms are plain dicts keyed by label
+values, so recording a sample is a dict lookup and a couple of additions and
+costs nothing measurable next to a Redis round trip. Everything is
+per-process; Prometheus sums across workers.
+"""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+_metrics: List["Metric"] = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+        _metrics.append(self)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # [per-bucket counts (last one is +Inf), sum, count]
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, (counts, total, count) in self.values.items():
+            # Buckets are stored individually and made cumulative on scrape
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(line for metric in _metrics for line in metric.render()) + "\n"
+
+# Game loop
+TICKS = Counter("game_ticks_total", "Game ticks run", ("shard",))
+TICK_SECONDS = Histogram("game_tick_seconds", "Wall time of a whole game tick", ("shard",))
+TICK_OVERRUNS = Counter("game_tick_overruns_total", "Ticks that took longer than the tick interval", ("shard",))
+SYSTEM_SECONDS = Histogram("game_system_seconds", "Wall time of one tick system", ("shard", "system"))
+SYSTEM_ROUND_TRIPS = Histogram(
+    "game_system_redis_round_trips", "Redis round trips made by one tick system", ("shard", "system"), COUNT_BUCKETS
+)
+QUEUE_DEPTH = Histogram("game_queue_depth", "Pending work at the start of a tick", ("shard", "queue"), COUNT_BUCKETS)
+EVENTS_PUBLISHED = Counter("game_events_published_total", "Events published by the tick systems", ("kind",))
+TICKS_SKIPPED = Counter("game_ticks_skipped_total", "Ticks skipped after falling more than an interval behind", ("shard",))
+TICK_LAG = Gauge("game_tick_lag_seconds", "How late the latest tick started", ("shard",))
+SYSTEM_DEFERRED = Counter("game_system_deferred_total", "Ticks a system was put off for lack of budget", ("shard", "system"))
+SYSTEM_OVER_BUDGET = Counter("game_system_over_budget_total", "Runs of a system that exceeded its own budget", ("shard", "system"))
+SYSTEM_FAILURES = Counter("game_system_failures_total", "Runs of a system that raised", ("shard", "system"))
+SYSTEM_BATCH_LIMIT = Gauge("game_system_batch_limit", "Queued items a batched system may take per tick", ("shard", "system"))
+WORK_SHED = Counter("game_work_shed_total", "Queued items dropped as stale", ("queue",))
+STORE_ENTITIES = Gauge("game_store_entities", "Entities held in the shard's in-process store", ("shard",))
+INTERACTIONS = Counter("game_interactions_total", "Queued interactions resolved, by outcome", ("result",))
+
+# Tick ownership
+TICK_LEADER = Gauge("tick_leader", "1 while this process owns the shard's simulation", ("shard",))
+LEADER_ELECTIONS = Counter("tick_leader_elections_total", "Times this process took tick ownership", ("shard",))
+LEADERSHIP_LOST = Counter("tick_leadership_lost_total", "Times this process lost tick ownership without giving it up", ("shard",))
+
+# Event fan-out
+HUB_MESSAGES = Counter("event_hub_messages_total", "Pubsub messages received by the event hub", ("kind",))
+HUB_DROPPED_CLIENTS = Counter("event_hub_dropped_clients_total", "Streaming clients dropped for falling behind")
+
+# Actions
+ACTION_BATCH_SIZE = Histogram("action_batch_size", "Action scripts sent per coalesced pipeline", (), COUNT_BUCKETS)
+ACTIONS_REJECTED = Counter("action_rejected_total", "Actions refused because their queue was full", ("queue",))
+
+# HTTP
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Request latency per route", ("method", "route", "status")
+)
+
+class RoundTripCounter:
+    """Redis client stand-in counting the round trips made through it
+
+    Every command or script call is one round trip, and so is a pipeline
+    however many commands it carries.
+    """
+    def __init__(self, redis, total: "Optional[RoundTripCounter]" = None):
+        self._redis = redis
+        self._total = total or self
+        self.count = 0
+
+    def counting(self, redis) -> "RoundTripCounter":
+        """Another client (the undecoded one, say) counted into the same total"""
+        return RoundTripCounter(redis, self._total)
+
+    def _counted(self):
+        self._total.count += 1
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if name == "pipeline":
+            return self._pipeline
+        if callable(attr) and name not in ("pubsub", "register_script"):
+            def command(*args, **kwargs):
+                self._counted()
+                return attr(*args, **kwargs)
+            return command
+        return attr
+
+    def _pipeline(self, *args, **kwargs):
+        pipe = self._redis.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def counted_execute(*args, **kwargs):
+            self._counted()
+            return await execute(*args, **kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+@contextmanager
+def timed_system(name: str, redis, shard: int = 0):
+    """Time one tick system and count its round trips; yields the redis to use"""
+    counted = RoundTripCounter(redis)
+    start = time.perf_counter()
+    try:
+        yield counted
+    finally:
+        SYSTEM_SECONDS.observe(time.perf_counter() - start, shard, name)
+        SYSTEM_ROUND_TRIPS.observe(counted.count, shard, name)
@@ -0,0 +1,152 @@
+"""Write-behind persistence of live Redis state back to SQLite.
+
+Systems that change an entity add its id to ``dirty:char``, ``dirty:npc`` or
+``dirty:object``. Every FLUSH_INTERVAL seconds (and on logout/shutdown) the
+persister takes those sets, reads the current values from Redis in one
+pipeline and writes them with executemany in a single SQLite transaction,
+so the database never sits on the hot path.
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Optional, List, Tuple
+from database import get_redis, run_sqlite
+from storage import stored_fields
+
+FLUSH_INTERVAL = float(os.getenv('PERSIST_INTERVAL', '5.0'))
+
+# kind -> (fields read from Redis, UPDATE statement taking those fields then the id)
+PERSISTED = {
+    "char": (("x", "y", "health"), "UPDATE characters SET x = ?, y = ?, health = ? WHERE charid = ?"),
+    "npc": (("x", "y", "health"), "UPDATE characters SET x = ?, y = ?, health = ? WHERE charid = ?"),
+    # e.g. a looted chest, so it stays looted once its instance is reloaded
+    "object": (("x", "y", "state"), "UPDATE game_objects SET x = ?, y = ?, state = ? WHERE object_id = ?"),
+}
+# Written as they are; every other field is a number
+TEXT_FIELDS = ("state",)
+
+def _write_batches(conn, batches: List[Tuple[str, list]]):
+    with conn:
+        for statement, rows in batches:
+            conn.executemany(statement, rows)
+
+class WriteBehindPersister:
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self.last_flush = time.monotonic()
+        self.stats = {
+            "flushes": 0,
+            "rows_written": 0,
+            "last_batch_sizes": {kind: 0 for kind in PERSISTED},
+            "last_flush_seconds": 0.0,
+            "last_lag_seconds": 0.0,
+            "failures": 0,
+        }
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, redis):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(redis))
+
+    async def stop(self, redis):
+        """Stop the periodic flush and write out whatever is still dirty"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(redis)
+
+    async def flush(self, redis) -> Dict[str, int]:
+        """Persist every dirty entity; returns the batch size per kind"""
+        async with self._lock:
+            start = time.monotonic()
+            pipe = redis.pipeline(transaction=True)
+            for kind in PERSISTED:
+                pipe.smembers(f"dirty:{kind}")
+                pipe.delete(f"dirty:{kind}")
+            taken = await pipe.execute()
+            dirty = {kind: list(taken[i * 2]) for i, kind in enumerate(PERSISTED)}
+
+            sizes = await self._persist(redis, dirty)
+
+            # Data written now may be as old as the previous flush
+            self.stats["last_lag_seconds"] = start - self.last_flush
+            self.last_flush = start
+            self.stats["flushes"] += 1
+            self.stats["rows_written"] += sum(sizes.values())
+            self.stats["last_batch_sizes"] = sizes
+            self.stats["last_flush_seconds"] = time.monotonic() - start
+            return sizes
+
+    async def flush_entity(self, redis, kind: str, entity_id) -> bool:
+        """Persist one entity right away, e.g. on logout"""
+        async with self._lock:
+            await redis.srem(f"dirty:{kind}", entity_id)
+            sizes = await self._persist(redis, {kind: [str(entity_id)]})
+            return sizes.get(kind, 0) > 0
+
+    async def _persist(self, redis, dirty: Dict[str, list]) -> Dict[str, int]:
+        pipe = redis.pipeline(transaction=False)
+        for kind, ids in dirty.items():
+            fields = PERSISTED[kind][0]
+            for entity_id in ids:
+                pipe.hmget(f"{kind}:{entity_id}", *stored_fields(*fields))
+        values = iter(await pipe.execute())
+
+        batches, sizes = [], {}
+        for kind, ids in dirty.items():
+            fields, statement = PERSISTED[kind]
+            rows = []
+            for entity_id in ids:
+                row = next(values)
+                # Entities that left Redis meanwhile have nothing to write
+                if any(v is None for v in row):
+                    continue
+                rows.append((*(v if field in TEXT_FIELDS else float(v) for field, v in zip(fields, row)),
+                             int(entity_id)))
+            if rows:
+                batches.append((statement, rows))
+            sizes[kind] = len(rows)
+
+        try:
+            if batches:
+                await run_sqlite(_write_batches, batches)
+        except Exception:
+            # Put them back so the next flush retries
+            self.stats["failures"] += 1
+            pipe = redis.pipeline(transaction=False)
+            for kind, ids in dirty.items():
+                if ids:
+                    pipe.sadd(f"dirty:{kind}", *ids)
+            await pipe.execute()
+            raise
+        return sizes
+
+    async def _run(self, redis):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush(redis)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Write-behind flush failed: {e}")
+
+_persister: Optional[WriteBehindPersister] = None
+
+async def get_persister() -> WriteBehindPersister:
+    global _persister
+    if _persister is None:
+        _persister = WriteBehindPersister()
+        _persister.start(await get_redis())
+    return _persister
+
+async def close_persister():
+    global _persister
+    if _persister is not None:
+        await _persister.stop(await get_redis())
+        _persister = None
@@ -1,132 +1,106 @@
 #!/usr/bin/env python3
+import csv
 import sqlite3
 import asyncio
 import os
-import pandas as pd
+import time
+from itertools import islice
 from pathlib import Path
-from database import get_sqlite_connection, init_databases
+from database import get_sqlite_connection, init_databases, get_redis
 
-DATA_DIR = Path("/app/data/pre_data")
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data/pre_data"))
+
+# Rows per executemany call; bounds memory, so it stays flat no matter how
+# large the CSV files are.
+SQLITE_CHUNK_SIZE = 50_000
+
+def _coerce(value: str):
+    """CSV values are strings; store numbers as numbers like pandas did"""
+    if value == "":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def _chunks(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 async def load_all_csv_data(conn: sqlite3.Connection):
-    """Load all CSV files from data directory into SQLite"""
+    """Stream all CSV files from data directory into SQLite"""
     print(f"Loading data from {DATA_DIR}...")
-    
+
     # Get all CSV files in data directory
     csv_files = list(DATA_DIR.glob("*.csv"))
     if not csv_files:
         raise FileNotFoundError(f"No CSV files found in {DATA_DIR}")
-    
+
     loaded_tables = []
-    
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
+
     for csv_file in csv_files:
         table_name = csv_file.stem  # Use filename without extension as table name
+        # A file that fails halfway leaves none of its rows behind
+        conn.execute("SAVEPOINT csv_file")
         try:
-            df = pd.read_csv(csv_file, keep_default_na=False)
-            if df.empty:
+            with open(csv_file, newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                if not header:
+                    conn.execute("RELEASE csv_file")
+                    print(f"⚠️  Empty CSV file: {csv_file.name}")
+                    continue
+                columns = [col.strip() for col in header]
+                column_list = ", ".join(f'"{col}"' for col in columns)
+
+                # Tables without a schema in init_databases are created untyped
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({column_list})')
+                insert = f'INSERT INTO "{table_name}" ({column_list}) VALUES ({", ".join("?" * len(columns))})'
+
+                # TEXT columns (e.g. a collision_map of 0s and 1s) stay strings
+                declared = {row[1]: row[2].upper() for row in conn.execute(f'PRAGMA table_info("{table_name}")')}
+                convert = [(lambda v: v) if "TEXT" in declared.get(col, "") else _coerce for col in columns]
+
+                start = time.perf_counter()
+                rows = 0
+                for chunk in _chunks(reader, SQLITE_CHUNK_SIZE):
+                    conn.executemany(insert, ([c(v) for c, v in zip(convert, row)] for row in chunk))
+                    rows += len(chunk)
+                    if rows % (SQLITE_CHUNK_SIZE * 10) == 0:
+                        print(f"   {table_name}: {rows} rows ({rows / (time.perf_counter() - start):.0f}/s)")
+
+            conn.execute("RELEASE csv_file")
+            if rows == 0:
                 print(f"⚠️  Empty CSV file: {csv_file.name}")
                 continue
-            
-            # Clean column names and convert to string to prevent type issues
-            df.columns = [col.strip() for col in df.columns]
-            str_cols = df.select_dtypes(include=['object']).columns
-            df[str_cols] = df[str_cols].astype(str)
-            
-            df.to_sql(
-                name=table_name,
-                con=conn,
-                if_exists='append',
-                index=False
-            )
             loaded_tables.append(table_name)
-            print(f"✅ Loaded {len(df)} rows into {table_name}")
-            
+            print(f"✅ Loaded {rows} rows into {table_name}")
+
         except Exception as e:
+            conn.execute("ROLLBACK TO csv_file")
+            conn.execute("RELEASE csv_file")
             print(f"❌ Failed to load {csv_file.name}: {str(e)}")
             continue
-    
+
     return loaded_tables
 
-async def load_to_redis(conn: sqlite3.Connection, redis):
-    """Selectively load specific tables to Redis with custom logic"""
-    print("\nTransferring data to Redis...")
-    
-    # Character/Player loading
-    try:
-        chars_df = pd.read_sql("SELECT * FROM characters", conn)
-        if not chars_df.empty:
-            pipe = redis.pipeline()
-            for _, row in chars_df.iterrows():
-                is_npc = row['userid'] == 'npc'
-                prefix = 'npc' if is_npc else 'char'
-                key = f"{prefix}:{row['charid']}"
-                
-                pipe.hset(key, mapping={
-                    'name': str(row['name']),
-                    'x': str(row['x']),
-                    'y': str(row['y']),
-                    'health': str(row.get('health', '')),
-                    'max_health': str(row.get('max_health', '')),
-                    'instance': str(row.get('instance', '')),
-                    'state': 'idle' if is_npc else 'online'
-                })
-                
-                if is_npc:
-                    pipe.sadd('npcs', row['charid'])
-                else:
-                    pipe.sadd('online_chars', row['charid'])
-            
-            await pipe.execute()
-            print(f"✅ Loaded {len(chars_df)} characters to Redis")
-    except Exception as e:
-        print(f"❌ Failed to load characters: {str(e)}")
-    
-    # Game Objects loading
-    try:
-        objects_df = pd.read_sql("SELECT * FROM game_objects", conn)
-        if not objects_df.empty:
-            pipe = redis.pipeline()
-            for _, row in objects_df.iterrows():
-                key = f"object:{row['object_id']}"
-                pipe.hset(key, mapping={
-                    'name': str(row['name']),
-                    'x': str(row['x']),
-                    'y': str(row['y']),
-                    'type': str(row['type']),
-                    'instance': str(row.get('instance', '')),
-                    'state': 'active'
-                })
-                pipe.sadd('world_objects', row['object_id'])
-            
-            await pipe.execute()
-            print(f"✅ Loaded {len(objects_df)} objects to Redis")
-    except Exception as e:
-        print(f"❌ Failed to load game objects: {str(e)}")
-    
-    # Map Instances loading
-    try:
-        instances_df = pd.read_sql("SELECT * FROM instances", conn)
-        if not instances_df.empty:
-            pipe = redis.pipeline()
-            for _, row in instances_df.iterrows():
-                key = f"instance:{row['instance_id']}"
-                pipe.hset(key, mapping={
-                    'name': str(row['name']),
-                    'x_size': str(row['x_size']),
-                    'y_size': str(row['y_size']),
-                    'tags': str(row.get('tags', ''))
-                })
-                if 'height_map' in row:
-                    pipe.set(f"{key}:height", str(row['height_map']))
-                if 'collision_map' in row:
-                    pipe.set(f"{key}:collision", str(row['collision_map']))
-            
-            await pipe.execute()
-            print(f"✅ Loaded {len(instances_df)} instances to Redis")
-    except Exception as e:
-        print(f"❌ Failed to load instances: {str(e)}")
-    
-    # Set world metadata
+async def load_to_redis(redis):
+    """Mark the world as ready in Redis
+
+    Characters, NPCs, objects and instances stay in SQLite: an instance is
+    loaded into Redis by the first login into it and evicted once it has been
+    idle (see lib.load_instance), so Redis only holds the instances in play.
+    """
     await redis.set("world:instanced", "true")
     print("✅ Set world metadata in Redis")
 
@@ -144,15 +118,15 @@ async def main():
             await redis.flushdb()
             print("Cleared Redis for development mode")
         
-        # Load all CSV data into SQLite
+        # Load all CSV data into SQLite, in one transaction
         loaded_tables = await load_all_csv_data(conn)
         conn.commit()
         
         if not loaded_tables:
             raise RuntimeError("No tables were loaded from CSV files")
         
-        # Transfer specific tables to Redis
-        await load_to_redis(conn, redis)
+        # Instances are loaded into Redis on demand
+        await load_to_redis(redis)
         
         print("\nDatabase population complete!")
         print(f"Loaded tables: {', '.join(loaded_tables)}")
@@ -0,0 +1,151 @@
+"""Fixed-timestep tick scheduler.
+
+Ticks are numbered and paced against the monotonic clock: tick n is due at
+start + n * interval, so a slow tick is caught up on by sleeping less
+afterwards instead of shifting every later tick. When the loop falls more
+than a whole interval behind, the missed ticks are skipped (and counted)
+rather than run back to back.
+
+Systems are registered with a frequency (every N ticks) and a priority, and
+run in priority order within a per-tick work budget:
+
+- batched systems are handed a limit on how many queued items to take,
+  sized from the budget left and their measured cost per item; whatever
+  doesn't fit stays queued for the next tick;
+- once the budget is spent, deferrable systems are skipped for this tick
+  and their work waits; the others always run, and so does a system that
+  was already put off MAX_DEFERRALS ticks in a row, so none starves.
+
+Slow ticks therefore cost a bounded amount of time instead of stretching
+the whole world.
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, List, Optional
+import metrics
+
+TICK_INTERVAL = float(os.getenv("TICK_INTERVAL", "0.6"))
+# Share of the interval systems may use; the rest absorbs jitter
+TICK_BUDGET = float(os.getenv("TICK_BUDGET", str(TICK_INTERVAL * 0.8)))
+
+# Batch sizes used until a system's cost per item has been measured, and
+# never gone below so a backlog always drains
+INITIAL_BATCH = 1000
+MIN_BATCH = 100
+# Weight of the latest measurement in the cost per item average
+COST_SMOOTHING = 0.2
+MAX_DEFERRALS = 5
+
+class TickSystem:
+    def __init__(self, name: str, fn: Callable[..., Awaitable], every: int = 1, priority: int = 0,
+                 budget: Optional[float] = None, batched: bool = False, deferrable: bool = True,
+                 fenced: bool = False):
+        self.name = name
+        self.fn = fn
+        self.every = every
+        self.priority = priority
+        self.budget = budget
+        self.batched = batched
+        self.deferrable = deferrable
+        self.fenced = fenced
+        self.next_tick = 0
+        self.deferrals = 0
+        self.cost_per_item: Optional[float] = None
+
+    def batch_limit(self, remaining: float) -> int:
+        """How many queued items fit in the remaining time"""
+        if self.budget is not None:
+            remaining = min(remaining, self.budget)
+        if not self.cost_per_item:
+            return INITIAL_BATCH
+        return max(MIN_BATCH, int(remaining / self.cost_per_item))
+
+    def record_cost(self, seconds: float, items: int):
+        if items <= 0:
+            return
+        cost = seconds / items
+        if self.cost_per_item is None:
+            self.cost_per_item = cost
+        else:
+            self.cost_per_item += COST_SMOOTHING * (cost - self.cost_per_item)
+
+class TickScheduler:
+    def __init__(self, interval: float = TICK_INTERVAL, budget: float = TICK_BUDGET, shard: int = 0,
+                 fence: Optional[int] = None):
+        self.interval = interval
+        self.budget = budget
+        self.shard = shard
+        # Fencing token of the tick owner, see leader.py
+        self.fence = fence
+        self.tick = 0
+        self.systems: List[TickSystem] = []
+
+    def register(self, name: str, fn: Callable[..., Awaitable], **options) -> TickSystem:
+        """Add a system; batched ones are called as fn(redis, limit), fenced
+        ones also get fence=token"""
+        system = TickSystem(name, fn, **options)
+        self.systems.append(system)
+        self.systems.sort(key=lambda s: s.priority)
+        return system
+
+    async def run_tick(self, redis):
+        """Run every system due this tick within the budget"""
+        start = time.monotonic()
+        deadline = start + self.budget
+        for system in self.systems:
+            if self.tick < system.next_tick:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and system.deferrable and system.deferrals < MAX_DEFERRALS:
+                # Left for the next tick, its work stays queued
+                system.deferrals += 1
+                metrics.SYSTEM_DEFERRED.inc(self.shard, system.name)
+                continue
+            system.next_tick = self.tick + system.every
+            system.deferrals = 0
+
+            kwargs = {"fence": self.fence} if system.fenced else {}
+            system_start = time.monotonic()
+            try:
+                with metrics.timed_system(system.name, redis, self.shard) as r:
+                    if system.batched:
+                        limit = system.batch_limit(remaining)
+                        metrics.SYSTEM_BATCH_LIMIT.set(limit, self.shard, system.name)
+                        taken = await system.fn(r, limit, **kwargs)
+                    else:
+                        await system.fn(r, **kwargs)
+            except Exception as e:
+                metrics.SYSTEM_FAILURES.inc(self.shard, system.name)
+                print(f"System {system.name} failed on shard {self.shard} tick {self.tick}: {e}")
+                continue
+            elapsed = time.monotonic() - system_start
+            if system.batched:
+                system.record_cost(elapsed, taken)
+            if system.budget is not None and elapsed > system.budget:
+                metrics.SYSTEM_OVER_BUDGET.inc(self.shard, system.name)
+
+        elapsed = time.monotonic() - start
+        metrics.TICKS.inc(self.shard)
+        metrics.TICK_SECONDS.observe(elapsed, self.shard)
+        if elapsed > self.interval:
+            metrics.TICK_OVERRUNS.inc(self.shard)
+
+    async def run(self, redis):
+        """Tick forever at a fixed rate"""
+        origin = time.monotonic() - self.tick * self.interval
+        while True:
+            due = origin + self.tick * self.interval
+            metrics.TICK_LAG.set(max(0.0, time.monotonic() - due), self.shard)
+            await self.run_tick(redis)
+            self.tick += 1
+
+            due = origin + self.tick * self.interval
+            behind = time.monotonic() - due
+            if behind >= self.interval:
+                # Skip what was missed instead of bursting to catch up
+                missed = int(behind // self.interval)
+                self.tick += missed
+                metrics.TICKS_SKIPPED.inc(self.shard, amount=missed)
+                due += missed * self.interval
+            await asyncio.sleep(max(0.0, due - time.monotonic()))
@@ -0,0 +1,285 @@
+"""Server-side Lua scripts used by the runtime tools and systems"""
+from typing import Dict, Sequence, Any
+from storage import LAYOUT
+
+# Stored names of entity hash fields as the Lua table F (see storage.py)
+ENTITY_FIELDS = LAYOUT.lua_fields()
+
+# Takes up to a batch of items off a queue (the oldest first), unless the
+# caller is a stale tick owner (see leader.py); the rest wait for the next tick.
+# KEYS[1] = queue, KEYS[2] = fencing token key
+# ARGV[1] = batch limit (0 = whole queue), ARGV[2] = fencing token ('' = unfenced)
+# Returns the items taken
+TAKE_BATCH = """
+if ARGV[2] ~= '' and redis.call('GET', KEYS[2]) ~= ARGV[2] then
+    return redis.error_reply('FENCED stale tick owner')
+end
+local limit = tonumber(ARGV[1]) or 0
+local items = redis.call('LRANGE', KEYS[1], 0, limit - 1)
+if #items > 0 then
+    if limit > 0 then
+        redis.call('LTRIM', KEYS[1], #items, -1)
+    else
+        redis.call('DEL', KEYS[1])
+    end
+end
+return items
+"""
+
+# Writes entities back from a shard's in-process store (see entities.py),
+# skipping those whose hash is gone, unless the caller is a stale tick owner.
+# Written entities are marked dirty for persistence.
+# KEYS[1] = fencing token key
+# ARGV[1] = fencing token ('' = unfenced),
+# ARGV[2..] = kind, id, x, y, health, state for every entity; x/y and
+# health/state are '' when unchanged and left as they are
+# Returns the ids of the entities that no longer exist
+REPLICATE = ENTITY_FIELDS + """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return redis.error_reply('FENCED stale tick owner')
+end
+local missing = {}
+for i = 2, #ARGV, 6 do
+    local key = ARGV[i] .. ':' .. ARGV[i + 1]
+    if redis.call('EXISTS', key) == 1 then
+        if ARGV[i + 2] ~= '' then
+            redis.call('HSET', key, F.x, ARGV[i + 2], F.y, ARGV[i + 3])
+        end
+        if ARGV[i + 4] ~= '' then
+            redis.call('HSET', key, F.health, ARGV[i + 4], F.state, ARGV[i + 5])
+        end
+        redis.call('SADD', 'dirty:' .. ARGV[i], ARGV[i + 1])
+    else
+        missing[#missing + 1] = ARGV[i + 1]
+    end
+end
+return missing
+"""
+
+# Name of the queue of the shard simulating an entity's instance (see
+# shards.py), given the shard count and the queue name.
+SHARD_QUEUE = ENTITY_FIELDS + """
+local function shard_queue(key, shards, name)
+    local instance = tonumber(redis.call('HGET', key, F.instance))
+    local shard = 0
+    if instance then
+        shard = instance % tonumber(shards)
+    end
+    return '{shard:' .. shard .. '}:' .. name
+end
+"""
+
+# Records the latest movement intent of an existing character in its shard's
+# intents hash; the tick applies it.
+# KEYS[1] = char key
+# ARGV[1] = charid, ARGV[2] = intent, ARGV[3] = shard count, ARGV[4] = intents hash name
+RECORD_INTENT = SHARD_QUEUE + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', shard_queue(KEYS[1], ARGV[3], ARGV[4]), ARGV[1], ARGV[2])
+return 1
+"""
+
+# Takes every pending movement intent, unless the caller is a stale tick owner.
+# KEYS[1] = intents hash, KEYS[2] = fencing token key
+# ARGV[1] = fencing token ('' = unfenced)
+# Returns {charid, intent, ...}
+TAKE_INTENTS = """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return redis.error_reply('FENCED stale tick owner')
+end
+local intents = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+return intents
+"""
+
+# Takes the tick lease if nobody holds it, with a new fencing token.
+# KEYS[1] = lease key, KEYS[2] = fencing token key
+# ARGV[1] = node id, ARGV[2] = lease ttl (ms)
+# Returns the fencing token, or 0 if the lease is held
+ACQUIRE_LEASE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+return token
+"""
+
+# Extends the lease if it is still ours.
+# KEYS[1] = lease key
+# ARGV[1] = lease value, ARGV[2] = lease ttl (ms)
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Gives the lease up if it is still ours.
+# KEYS[1] = lease key
+# ARGV[1] = lease value
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+# Writes an entity hash and moves the entity to the grid cell of its new
+# position, dropping it from the cell it was indexed under before.
+# KEYS[1] = entity key
+# ARGV[1] = cell size, ARGV[2..] = field, value pairs
+PLACE = ENTITY_FIELDS + """
+local size = tonumber(ARGV[1])
+local old = redis.call('HMGET', KEYS[1], F.x, F.y, F.instance)
+if old[1] and old[2] and old[3] then
+    local old_cell = math.floor(tonumber(old[1]) / size) .. ':' .. math.floor(tonumber(old[2]) / size)
+    redis.call('SREM', 'instance:{' .. old[3] .. '}:cell:' .. old_cell, KEYS[1])
+end
+
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+
+local pos = redis.call('HMGET', KEYS[1], F.x, F.y, F.instance)
+if pos[1] and pos[2] and pos[3] and pos[3] ~= '' then
+    local new_cell = math.floor(tonumber(pos[1]) / size) .. ':' .. math.floor(tonumber(pos[2]) / size)
+    redis.call('SADD', 'instance:{' .. pos[3] .. '}:cell:' .. new_cell, KEYS[1])
+end
+return 1
+"""
+
+# Collects every entity within a radius of a character from the grid cells
+# its view circle overlaps.
+# KEYS[1] = char key
+# ARGV[1] = radius, ARGV[2] = cell size
+# Returns {instance, key, {field, value, ...}, key, {...}, ...}
+NEARBY = ENTITY_FIELDS + """
+local me = redis.call('HMGET', KEYS[1], F.x, F.y, F.instance)
+if not me[3] then
+    return false
+end
+local x = tonumber(me[1]) or 0
+local y = tonumber(me[2]) or 0
+local radius = tonumber(ARGV[1])
+local size = tonumber(ARGV[2])
+local r2 = radius * radius
+local prefix = 'instance:{' .. me[3] .. '}:cell:'
+
+local found = {me[3]}
+for cx = math.floor((x - radius) / size), math.floor((x + radius) / size) do
+    for cy = math.floor((y - radius) / size), math.floor((y + radius) / size) do
+        for _, key in ipairs(redis.call('SMEMBERS', prefix .. cx .. ':' .. cy)) do
+            if key ~= KEYS[1] then
+                local pos = redis.call('HMGET', key, F.x, F.y)
+                local ex, ey = tonumber(pos[1]), tonumber(pos[2])
+                if ex and ey and (ex - x) ^ 2 + (ey - y) ^ 2 <= r2 then
+                    found[#found + 1] = key
+                    found[#found + 1] = redis.call('HGETALL', key)
+                end
+            end
+        end
+    end
+end
+return found
+"""
+
+# Queues an action on the actor's shard if the actor and at least one of the
+# candidate targets exist in the actor's instance (and so belong to the same
+# shard), and the queue is shorter than its cap.
+# KEYS[1] = actor key, KEYS[2..] = candidate target keys
+# ARGV[1] = queue item, ARGV[2] = shard count, ARGV[3] = queue name,
+# ARGV[4] = queue length cap (optional, 0 = none)
+# Returns 1 when queued, 0 when the actor or targets are missing, -1 when full
+ENQUEUE_ACTION = SHARD_QUEUE + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local instance = redis.call('HGET', KEYS[1], F.instance)
+local found = false
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 1 and redis.call('HGET', KEYS[i], F.instance) == instance then
+        found = true
+        break
+    end
+end
+if not found then
+    return 0
+end
+local queue = shard_queue(KEYS[1], ARGV[2], ARGV[3])
+local cap = tonumber(ARGV[4]) or 0
+if cap > 0 and redis.call('LLEN', queue) >= cap then
+    return -1
+end
+redis.call('RPUSH', queue, ARGV[1])
+return 1
+"""
+
+# Moves objects from one state to another, each only if it is still in the
+# expected state, unless the caller is a stale tick owner. Changed objects
+# are marked dirty for persistence.
+# KEYS[1] = fencing token key
+# ARGV[1] = fencing token ('' = unfenced),
+# then object id, expected state, new state per object
+# Returns the ids of the objects that changed state
+SET_OBJECT_STATES = ENTITY_FIELDS + """
+if ARGV[1] ~= '' and redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return redis.error_reply('FENCED stale tick owner')
+end
+local changed = {}
+for i = 2, #ARGV, 3 do
+    local key = 'object:' .. ARGV[i]
+    if redis.call('HGET', key, F.state) == ARGV[i + 1] then
+        redis.call('HSET', key, F.state, ARGV[i + 2])
+        redis.call('SADD', 'dirty:object', ARGV[i])
+        changed[#changed + 1] = ARGV[i]
+    end
+end
+return changed
+"""
+
+# Deletes an idle instance from Redis unless a player is in it. The check and
+# the deletes are one step, so a login can't slip in between them.
+# KEYS[1] = players set, KEYS[2] = npcs set, KEYS[3] = objects set,
+# KEYS[4] = instance hash, KEYS[5] = empty_since, KEYS[6..] = cell sets
+# ARGV[1] = instance id, ARGV[2] = '1' to update the world-wide membership sets
+# Returns {npcs, objects} evicted, or nil when the instance has players
+EVICT_INSTANCE = """
+if redis.call('SCARD', KEYS[1]) > 0 then
+    return false
+end
+local function drop(members_key, prefix, world_set)
+    local ids = redis.call('SMEMBERS', members_key)
+    for i = 1, #ids, 1000 do
+        local keys, members = {}, {}
+        for j = i, math.min(i + 999, #ids) do
+            keys[#keys + 1] = prefix .. ids[j]
+            members[#members + 1] = ids[j]
+        end
+        redis.call('DEL', unpack(keys))
+        if ARGV[2] == '1' then
+            redis.call('SREM', world_set, unpack(members))
+        end
+    end
+    return #ids
+end
+local npcs = drop(KEYS[2], 'npc:', 'npcs')
+local objects = drop(KEYS[3], 'object:', 'world_objects')
+for i = 2, #KEYS do
+    redis.call('DEL', KEYS[i])
+end
+redis.call('SREM', 'loaded_instances', ARGV[1])
+return {npcs, objects}
+"""
+
+_registered: Dict[str, Any] = {}
+
+async def run_script(redis, source: str, keys: Sequence = (), args: Sequence = ()):
+    """Run a Lua script by SHA, loading it on the server the first time"""
+    script = _registered.get(source)
+    if script is None:
+        script = redis.register_script(source)
+        _registered[source] = script
+    return await script(keys=list(keys), args=list(args), client=redis)
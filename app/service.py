@@ -1,46 +1,57 @@
-from database import get_redis
-import json
+from database import get_redis, get_redis_raw
+from scripts import run_script, TAKE_BATCH, RECORD_INTENT, ENQUEUE_ACTION, TAKE_INTENTS, SET_OBJECT_STATES
+from spatial import entities_near, cell_of, cell_key, event_channel, region_of, DEFAULT_VIEW_RADIUS
+from collision import get_collision_map
+from leader import fence_key, fence_arg
+from shards import SIM_SHARDS, shard_key
+from codec import QUEUE_CODEC, EVENT_CODEC
+from coalescer import get_coalescer
+from entities import get_store, state_code, KINDS, NO_INSTANCE, POSITION, VITALS
+from storage import LAYOUT, stored_fields
+from metrics import QUEUE_DEPTH, EVENTS_PUBLISHED, WORK_SHED, INTERACTIONS, ACTIONS_REJECTED, RoundTripCounter
+import math
+import os
 import time
-import asyncio
-from typing import Optional
+import numpy as np
+from functools import partial
+from typing import Optional, List, Sequence
 
-async def get_info(charid: int, characters: List[int], npcs: List[int], items: List[int]):
+BASE_DAMAGE = 10
+# Attacks still queued after this many seconds are dropped, not resolved late
+COMBAT_MAX_AGE = 5.0
+# Longest step one move intent may take along each axis, in tiles
+MAX_MOVE_STEP = 5.0
+# Instances without a map end here, well inside what cells and regions can index
+WORLD_LIMIT = 1e6
+
+# How close a character has to be to an object to use it
+INTERACT_RANGE = 5.0
+INTERACTION_MAX_AGE = 5.0
+# Pending interactions per shard; past this /interact is refused until the
+# ticks catch up, instead of the queue growing without bound
+INTERACTION_QUEUE_MAX = int(os.getenv("INTERACTION_QUEUE_MAX", "10000"))
+# Objects can be used while in this state
+AVAILABLE_STATE = "active"
+# object type -> state left behind by the one character who gets to it.
+# Other types can be used by everyone at once and keep their state. Claimed
+# states are persisted, so a looted chest stays looted across evictions.
+CLAIMED_STATES = {"container": "looted"}
+
+async def get_info(charid: int, radius: float = DEFAULT_VIEW_RADIUS):
+    """Return every character, NPC and item within radius of a character"""
     elements = {"characters": {}, "npcs": {}, "items": {}}
     redis = await get_redis()
-    char_key = f"char:{charid}"
 
-    player_instance = await redis.hget(char_key, "instance")
-    if not player_instance:
+    nearby = await entities_near(redis, charid, radius)
+    if nearby is None:
         return {"status": False, "message": "Character does not exist or has no instance"}
 
-    # {"char:0000": ("characters",0000)}
-    entity_map = {f"char:{id}": ("characters", id) for id in characters}
-    entity_map.update({f"npc:{id}": ("npcs", id) for id in npcs})
-    entity_map.update({f"object:{id}": ("items", id) for id in items})
-    
-    all_keys = list(entity_map.keys())
-    
-    pipeline = redis.pipeline()
-    for key in all_keys:
-        pipeline.hget(key, "instance")
-    instances = await pipeline.execute()
-    
-    valid_keys = []
-    for key, instance_val in zip(all_keys, instances):
-        if instance_val and instance_val.decode() == player_instance.decode():
-            valid_keys.append(key)
-    
-    if not valid_keys:
-        return {"status": True, "elements": elements}
-    
-    pipeline = redis.pipeline()
-    for key in valid_keys:
-        pipeline.hgetall(key)
-    results = await pipeline.execute()
-    
-    for key, data in zip(valid_keys, results):
-        category, entity_id = entity_map[key]
-        elements[category][entity_id] = {k.decode(): v.decode() for k, v in data.items()}
+    # {"char:0000": "characters"}
+    categories = {"char": "characters", "npc": "npcs", "object": "items"}
+    _, entities = nearby
+    for key, data in entities.items():
+        prefix, entity_id = key.split(":", 1)
+        elements[categories[prefix]][int(entity_id)] = data
     
     return {"status": True, "elements": elements}
 
@@ -60,118 +71,342 @@ async def char_has_vision(char_key, target_key): # inneficient, not for batch us
     return False
 
 # Runtime Tools
+# Each action is validated and recorded by a single script call, batched
+# with the calls of concurrent requests into one pipeline (see coalescer.py).
+# The tick systems below apply them in bulk.
 async def move_direction(charid: int, dx: float, dy: float) -> bool:
-    char_key = f"char:{charid}"
-    redis = await get_redis()
-    if not await redis.exists(char_key):
+    if not (math.isfinite(dx) and math.isfinite(dy)):
         return False
-    
-    # Get current position
-    char_data = await redis.hgetall(char_key)
-    x = float(char_data.get("x", 0))
-    y = float(char_data.get("y", 0))
-    
-    # Update position
-    new_x = x + dx
-    new_y = y + dy
-    
-    # Collision check
-    if not await detect_collision(new_x, new_y):
-        await redis.hset(char_key, mapping={
-            "x": new_x,
-            "y": new_y
-        })
-        await redis.publish("movement", json.dumps({
-            "charid": charid,
-            "x": new_x,
-            "y": new_y
-        }))
-        return True
-    return False
+    # Longer steps are cut short
+    dx = max(-MAX_MOVE_STEP, min(MAX_MOVE_STEP, dx))
+    dy = max(-MAX_MOVE_STEP, min(MAX_MOVE_STEP, dy))
+    # Only the latest intent per character is kept until the next tick
+    recorded = await get_coalescer().run_script(
+        RECORD_INTENT, keys=[f"char:{charid}"], args=[charid, f"{dx},{dy}", SIM_SHARDS, "move_intents"]
+    )
+    return bool(recorded)
 
 async def attack_direction(charid: int, target_id: int) -> bool:
-    redis = await get_redis()
     char_key = f"char:{charid}"
-    target_key = f"char:{target_id}"  # Could be player or NPC
-    
-    if not (await redis.exists(char_key) and await redis.exists(target_key)):
-        return False
+    target_keys = [f"char:{target_id}", f"npc:{target_id}"]  # Could be player or NPC
     
-    # Add to combat queue
-    await redis.rpush("combat_queue", json.dumps({
+    # Add to the combat queue of the attacker's shard
+    item = QUEUE_CODEC.encode("attack", {
         "attacker": charid,
         "target": target_id,
         "time": time.time()
-    }))
-    return True
+    })
+    queued = await get_coalescer().run_script(
+        ENQUEUE_ACTION, keys=[char_key, *target_keys], args=[item, SIM_SHARDS, "combat_queue"]
+    )
+    return bool(queued)
 
 async def interact_direction(charid: int, object_id: int) -> bool:
-    redis = await get_redis()
     char_key = f"char:{charid}"
     object_key = f"object:{object_id}"
     
-    if not (await redis.exists(char_key) and await redis.exists(object_key)):
-        return False
-    
-    # Add to interaction queue
-    await redis.rpush("interaction_queue", json.dumps({
+    # Add to the interaction queue of the character's shard
+    item = QUEUE_CODEC.encode("interact", {
         "charid": charid,
         "object_id": object_id,
         "time": time.time()
-    }))
-    return True
+    })
+    queued = await get_coalescer().run_script(
+        ENQUEUE_ACTION, keys=[char_key, object_key],
+        args=[item, SIM_SHARDS, "interaction_queue", INTERACTION_QUEUE_MAX]
+    )
+    if queued == -1:
+        ACTIONS_REJECTED.inc("interaction_queue")
+    return queued == 1
 
 # Systems
-async def detect_collision(x: float, y: float) -> bool:
-    """Check collision with world objects"""
-    # Placeholder implementation
-    return False
+def _parse_intent(intent: str):
+    try:
+        dx, dy = intent.split(",")
+        return float(dx), float(dy)
+    except ValueError:
+        return math.nan, math.nan  # malformed, never applied
+
+def _running_counts(values: np.ndarray) -> np.ndarray:
+    """1 for the first occurrence of each value, 2 for the second, ..."""
+    order = np.argsort(values, kind="stable")
+    ordered = values[order]
+    starts = np.flatnonzero(np.r_[True, ordered[1:] != ordered[:-1]])
+    counts = np.arange(len(values)) - np.repeat(starts, np.diff(np.r_[starts, len(values)]))
+    result = np.empty(len(values), dtype=np.int64)
+    result[order] = counts + 1
+    return result
+
+async def _take_actions(redis, shard: int, queue_name: str, kind: str, fields: Sequence[str], max_age: float,
+                        limit: int = 0, fence: Optional[int] = None):
+    """Take a shard's queued actions: (number taken, id `fields` of the fresh ones, their queue times)"""
+    queue = shard_key(shard, queue_name)
+    source = redis
+    if QUEUE_CODEC.binary:
+        # Binary items have to be read without decoding, still counted with the system
+        source = await get_redis_raw()
+        if isinstance(redis, RoundTripCounter):
+            source = redis.counting(source)
+    items = await run_script(source, TAKE_BATCH, keys=[queue, fence_key(shard)], args=[limit, fence_arg(fence)])
 
-async def calculate_damages(redis):  # Now accepts redis parameter
-    """Process combat queue on game tick"""
-    while await redis.llen("combat_queue") > 0:
-        combat_data = json.loads(await redis.lpop("combat_queue"))
-        attacker_id = combat_data["attacker"]
-        target_id = combat_data["target"]
-        
-        # Determine target type
-        target_key = f"char:{target_id}" if await redis.exists(f"char:{target_id}") else f"npc:{target_id}"
-        
-        if not await redis.exists(target_key):
+    cutoff = time.time() - max_age
+    ids, times, shed = [], [], 0
+    for raw in items:
+        try:
+            action = QUEUE_CODEC.decode(kind, raw)
+            values = [int(action[field]) for field in fields]
+            queued_at = float(action["time"])
+        except Exception:
+            continue  # malformed, dropped
+        # Stale ones are shed, not resolved late
+        if queued_at < cutoff:
+            shed += 1
             continue
-        
-        # Calculate damage
-        damage = 10  # Base damage
-        
-        # Apply damage
-        current_health = int(await redis.hget(target_key, "health"))
-        new_health = max(0, current_health - damage)
-        await redis.hset(target_key, "health", new_health)
-        
-        # Publish combat event
-        target_type = "char" if "char:" in target_key else "npc"
-        await redis.publish("combat", json.dumps({
-            "attacker": attacker_id,
-            "target": target_id,
+        ids.append(values)
+        times.append(queued_at)
+    WORK_SHED.inc(queue, amount=shed)
+    return len(items), np.array(ids, dtype=np.int64).reshape(-1, len(fields)), np.array(times)
+
+async def calculate_damages(redis, limit: int = 0, fence: Optional[int] = None, shard: int = 0):  # Now accepts redis parameter
+    """Resolve a shard's queued attacks: one health change per target and one combat frame per region"""
+    taken, actions, _ = await _take_actions(redis, shard, "combat_queue", "attack", ("attacker", "target"),
+                                            COMBAT_MAX_AGE, limit, fence)
+    if not len(actions):
+        return taken
+    attackers, targets = actions[:, 0], actions[:, 1]
+
+    store = get_store(shard)
+    rows = await store.load(redis, targets)
+    # Targets that logged out, were evicted or are simulated by another shard are missed
+    found = rows >= 0
+    rows, attackers = rows[found], attackers[found]
+    if not len(rows):
+        return taken
+
+    # Hits on targets that are already dead are wasted
+    alive = store.health[rows] > 0
+    rows, attackers = rows[alive], attackers[alive]
+    if not len(rows):
+        return taken
+
+    # All hits on a target add up to one health change
+    targets, target_of = np.unique(rows, return_inverse=True)
+    hits = np.bincount(target_of)
+    health = store.health[targets]
+    new_health = np.maximum(0.0, health - BASE_DAMAGE * hits)
+    store.health[targets] = new_health
+    died = new_health <= 0
+    store.state[targets[died]] = state_code("dead")
+    store.mark_dirty(targets, VITALS)
+
+    # The killer is whoever landed the hit that took the last of the health
+    killing = died[target_of] & (_running_counts(rows) == np.ceil(health / BASE_DAMAGE)[target_of])
+    killers = np.zeros(len(targets), dtype=np.int64)
+    killers[target_of[killing]] = attackers[killing]
+
+    # Damage per (target, attacker), sorted by target
+    pairs, pair_hits = np.unique(np.stack([target_of, attackers], axis=1), axis=0, return_counts=True)
+    breakdown = [[] for _ in targets]
+    for (target, attacker), count in zip(pairs.tolist(), pair_hits.tolist()):
+        breakdown[target].append({"attacker": attacker, "damage": float(BASE_DAMAGE * count)})
+
+    # One combat frame per region, with every target hit there this tick
+    frames, deaths = {}, []
+    ids, kinds = store.ids[targets].tolist(), store.kind[targets].tolist()
+    x, y, instances = store.x[targets].tolist(), store.y[targets].tolist(), store.instance[targets].tolist()
+    for i, target in enumerate(ids):
+        instance = instances[i] if instances[i] != NO_INSTANCE else ""
+        target_type = KINDS[kinds[i]]
+        frames.setdefault(event_channel("combat", instance, x[i], y[i]), []).append({
+            "target": target,
             "target_type": target_type,
-            "damage": damage,
-            "new_health": new_health
-        }))
-        
-        # Check for death
-        if new_health <= 0:
-            await redis.hset(target_key, "state", "dead")
-            await redis.publish("death", json.dumps({
-                "target": target_id,
+            "damage": float(BASE_DAMAGE * hits[i]),
+            "new_health": float(new_health[i]),
+            "attackers": breakdown[i]
+        })
+        if died[i]:
+            deaths.append((event_channel("death", instance, x[i], y[i]), EVENT_CODEC.encode("death", {
+                "target": target,
                 "target_type": target_type,
-                "killer": attacker_id
-            }))
+                "killer": int(killers[i])
+            })))
+
+    pipe = redis.pipeline(transaction=False)
+    for channel, frame in frames.items():
+        pipe.publish(channel, EVENT_CODEC.encode("combat", {"hits": frame}))
+    for channel, event in deaths:
+        pipe.publish(channel, event)
+    await pipe.execute()
+    EVENTS_PUBLISHED.inc("combat", amount=len(frames))
+    EVENTS_PUBLISHED.inc("death", amount=int(died.sum()))
+    return taken
+
+async def calculate_movements(redis, fence: Optional[int] = None, shard: int = 0):  # Now accepts redis parameter
+    """Apply a shard's pending move intents in one pass, swept against the collision maps"""
+    taken = await run_script(
+        redis, TAKE_INTENTS, keys=[shard_key(shard, "move_intents"), fence_key(shard)], args=[fence_arg(fence)]
+    )
+    if not taken:
+        return 0
+    charids = np.array(taken[::2], dtype=np.int64)
+    deltas = np.array([_parse_intent(intent) for intent in taken[1::2]], dtype=float).reshape(-1, 2)
+
+    store = get_store(shard)
+    rows = await store.load(redis, charids, kinds=("char",))
+    # Characters that logged out since recording their intent are dropped
+    found = rows >= 0
+    if not found.any():
+        return 0
+    rows, deltas = rows[found], deltas[found]
+    x, y = store.x[rows], store.y[rows]
+    instances = store.instance[rows]
+    # Intents recorded by anything but move_direction are held to its limits too
+    deltas = np.clip(deltas, -MAX_MOVE_STEP, MAX_MOVE_STEP)
+    new_x = x + deltas[:, 0]
+    new_y = y + deltas[:, 1]
+    # Nobody moves to a position cells can't index, so one bad intent can't
+    # fail the whole batch
+    moved = (np.isfinite(new_x) & np.isfinite(new_y)
+             & (np.abs(new_x) <= WORLD_LIMIT) & (np.abs(new_y) <= WORLD_LIMIT))
+
+    for instance in np.unique(instances):
+        collision_map = await get_collision_map(int(instance)) if instance != NO_INSTANCE else None
+        if collision_map is None:
+            continue
+        sel = np.flatnonzero((instances == instance) & moved)
+        new_x[sel] = np.clip(new_x[sel], 0, np.nextafter(collision_map.x_size, 0))
+        new_y[sel] = np.clip(new_y[sel], 0, np.nextafter(collision_map.y_size, 0))
+        moved[sel] = ~collision_map.segments_blocked(x[sel], y[sel], new_x[sel], new_y[sel])
+
+    store.x[rows[moved]] = new_x[moved]
+    store.y[rows[moved]] = new_y[moved]
+    store.mark_dirty(rows[moved], POSITION)
+
+    pipe = redis.pipeline(transaction=False)
+    ids = store.ids[rows].tolist()
+    for i in np.flatnonzero(moved).tolist():
+        char_key = f"char:{ids[i]}"
+        instance = int(instances[i]) if instances[i] != NO_INSTANCE else ""
+        nx, ny = float(new_x[i]), float(new_y[i])
+        # Cells follow the position as stored (rounded in the compact layout), like PLACE
+        old_cell = cell_of(LAYOUT.value("x", x[i]), LAYOUT.value("y", y[i]))
+        new_cell = cell_of(LAYOUT.value("x", nx), LAYOUT.value("y", ny))
+        if instance != "" and old_cell != new_cell:
+            pipe.srem(cell_key(instance, *old_cell), char_key)
+            pipe.sadd(cell_key(instance, *new_cell), char_key)
+        # Announced in the new region, and in the old one when leaving it
+        event = EVENT_CODEC.encode("movement", {
+            "charid": ids[i],
+            "x": nx,
+            "y": ny
+        })
+        pipe.publish(event_channel("movement", instance, nx, ny), event)
+        if region_of(x[i], y[i]) != region_of(nx, ny):
+            pipe.publish(event_channel("movement", instance, x[i], y[i]), event)
+    await pipe.execute()
+    EVENTS_PUBLISHED.inc("movement", amount=int(moved.sum()))
+    return int(moved.sum())
+
+async def process_interactions(redis, limit: int = 0, fence: Optional[int] = None, shard: int = 0):
+    """Resolve a shard's queued interactions, each claimable object going to one character per tick"""
+    taken, actions, times = await _take_actions(redis, shard, "interaction_queue", "interact", ("charid", "object_id"),
+                                                INTERACTION_MAX_AGE, limit, fence)
+    if not len(actions):
+        return taken
+
+    store = get_store(shard)
+    rows = await store.load(redis, actions[:, 0], kinds=("char",))
+    # Characters that logged out since are dropped
+    found = rows >= 0
+    INTERACTIONS.inc("invalid", amount=int((~found).sum()))
+    if not found.any():
+        return taken
+    rows = rows[found]
+    charids, times = actions[found, 0], times[found]
+    objects, object_of = np.unique(actions[found, 1], return_inverse=True)
+
+    pipe = redis.pipeline(transaction=False)
+    for object_id in objects.tolist():
+        pipe.hmget(f"object:{object_id}", *stored_fields("x", "y", "instance", "type", "state"))
+    object_x = np.full(len(objects), np.nan)
+    object_y = np.full(len(objects), np.nan)
+    object_instance = np.full(len(objects), NO_INSTANCE, dtype=np.int64)
+    available = np.zeros(len(objects), dtype=bool)
+    claims: List[Optional[str]] = [None] * len(objects)
+    for i, (x, y, instance, object_type, state) in enumerate(await pipe.execute()):
+        # Gone, or not in any instance
+        if x is None or y is None or not instance:
+            continue
+        object_x[i], object_y[i], object_instance[i] = float(x), float(y), int(instance)
+        available[i] = state == AVAILABLE_STATE
+        claims[i] = CLAIMED_STATES.get(object_type)
+    claimed_type = np.array([claim is not None for claim in claims])
+
+    near = ((object_instance[object_of] != NO_INSTANCE)
+            & (store.instance[rows] == object_instance[object_of])
+            & (np.hypot(store.x[rows] - object_x[object_of], store.y[rows] - object_y[object_of]) <= INTERACT_RANGE))
+    usable = near & available[object_of]
+    shared = np.flatnonzero(usable & ~claimed_type[object_of])
+    # Contenders for each claimable object, earliest then lowest charid first
+    contenders = np.flatnonzero(usable & claimed_type[object_of])
+    contenders = contenders[np.lexsort((charids[contenders], times[contenders], object_of[contenders]))]
+    first = np.diff(object_of[contenders], prepend=-1) != 0
+    winners, losers = contenders[first], contenders[~first]
+
+    claimed = set()
+    if len(winners):
+        args = [fence_arg(fence)]
+        for i in winners.tolist():
+            args.extend((int(objects[object_of[i]]), AVAILABLE_STATE, claims[object_of[i]]))
+        # Only from the state read above, in case someone else got there since
+        changed = await run_script(redis, SET_OBJECT_STATES, keys=[fence_key(shard)], args=args)
+        claimed = {int(object_id) for object_id in changed}
+
+    outcomes = [(i, "ok") for i in shared.tolist()]
+    outcomes += [(i, "ok" if int(objects[object_of[i]]) in claimed else "taken") for i in winners.tolist()]
+    # In range of something already in use is taken too
+    outcomes += [(i, "taken") for i in losers.tolist() + np.flatnonzero(near & ~usable).tolist()]
+
+    pipe = redis.pipeline(transaction=False)
+    ok = 0
+    for i, result in outcomes:
+        j = object_of[i]
+        pipe.publish(event_channel("interaction", int(object_instance[j]), object_x[j], object_y[j]),
+                     EVENT_CODEC.encode("interaction", {
+                         "charid": int(charids[i]),
+                         "object_id": int(objects[j]),
+                         "result": result
+                     }))
+        ok += result == "ok"
+    await pipe.execute()
+    EVENTS_PUBLISHED.inc("interaction", amount=len(outcomes))
+    INTERACTIONS.inc("ok", amount=ok)
+    INTERACTIONS.inc("taken", amount=len(outcomes) - ok)
+    INTERACTIONS.inc("invalid", amount=len(rows) - len(outcomes))
+    return taken
+
+async def replicate_entities(redis, fence: Optional[int] = None, shard: int = 0):
+    """Write what the systems changed this tick back to Redis, for readers"""
+    return await get_store(shard).replicate(redis, fence)
+
+# Pending work sampled at the start of every tick
+QUEUES = {"combat_queue": "llen", "interaction_queue": "llen", "move_intents": "hlen"}
 
-async def calculate_movements(redis):  # Now accepts redis parameter
-    """Process movement queues (if any)"""
-    pass
+async def sample_queue_depths(redis, shard: int = 0):
+    pipe = redis.pipeline(transaction=False)
+    for queue, length in QUEUES.items():
+        getattr(pipe, length)(shard_key(shard, queue))
+    for queue, depth in zip(QUEUES, await pipe.execute()):
+        QUEUE_DEPTH.observe(depth, shard, queue)
 
-async def game_tick(redis):  # Now accepts redis parameter
-    """Process one game tick (0.6s)"""
-    await calculate_damages(redis)
-    await calculate_movements(redis)
+def register_systems(scheduler, shard: int = 0):
+    """Register the game systems of a shard on its tick scheduler, most important first"""
+    scheduler.register("queues", partial(sample_queue_depths, shard=shard), priority=0, deferrable=False)
+    scheduler.register("damages", partial(calculate_damages, shard=shard), priority=1, batched=True, fenced=True)
+    # Intents only keep the latest move, so a deferred tick loses nothing
+    scheduler.register("movements", partial(calculate_movements, shard=shard), priority=2, fenced=True)
+    # Looting can wait a tick; it never gets more than a quarter of one
+    scheduler.register("interactions", partial(process_interactions, shard=shard), priority=3,
+                       budget=scheduler.budget / 4, batched=True, fenced=True)
+    # Last, so readers see the whole tick; never put off or the replica falls behind
+    scheduler.register("replicate", partial(replicate_entities, shard=shard), priority=9, deferrable=False, fenced=True)
@@ -0,0 +1,125 @@
+"""WebSocket game sessions: actions upstream, events and snapshots downstream.
+
+One long-lived socket per player replaces the per-action HTTP POSTs and the
+separate SSE stream. Frames are compact JSON arrays:
+
+client -> server
+    ["m", seq, dx, dy]        move
+    ["a", seq, target_id]     attack
+    ["i", seq, object_id]     interact
+    ["g", seq, radius]        neighbourhood snapshot (radius optional)
+
+server -> client
+    ["c", codec]              event encoding picked from ?codec=, sent first
+    ["s", elements]           snapshot sent right after connecting
+    ["r", seq, ok, result?]   reply to the request with the same seq
+    ["e", kind, event]        event from the character's area of interest
+    ["x", message]            protocol error
+
+With a binary codec (?codec=struct or msgpack, see codec.py) events come as
+binary frames instead: b"e", one byte with the length of the kind, the kind,
+then the encoded event.
+"""
+import asyncio
+import json
+from typing import Optional
+from fastapi import WebSocket
+from database import get_redis
+from events import get_event_hub
+from codec import negotiate
+from storage import get_position
+from service import move_direction, attack_direction, interact_direction, get_info, DEFAULT_VIEW_RADIUS
+
+# op -> (handler, argument types)
+ACTIONS = {
+    "m": (move_direction, (float, float)),
+    "a": (attack_direction, (int,)),
+    "i": (interact_direction, (int,)),
+}
+
+async def run_session(websocket: WebSocket, charid: int, offered_codec: Optional[str] = None):
+    redis = await get_redis()
+    x, y, instance = await get_position(redis, f"char:{charid}")
+    if x is None or y is None:
+        await websocket.close(code=4404, reason="Character not logged in")
+        return
+    await websocket.accept()
+
+    codec = negotiate(offered_codec)
+    await websocket.send_text(json.dumps(["c", codec.name]))
+
+    hub = await get_event_hub()
+    queue = hub.subscribe_area(charid, instance or "", float(x), float(y))
+    send_lock = asyncio.Lock()
+
+    async def send(frame):
+        async with send_lock:
+            if isinstance(frame, bytes):
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+
+    async def push_events():
+        while True:
+            event = await queue.get()
+            if event is None:  # Dropped for falling behind
+                await websocket.close(code=1013, reason="Too slow")
+                return
+            data = event.encode(codec)
+            if codec.binary:
+                kind = event.kind.encode()
+                await send(b"e" + bytes([len(kind)]) + kind + data)
+            else:
+                # Event payloads are already JSON, so they are spliced in as is
+                await send(f'["e","{event.kind}",{data}]')
+
+    async def handle_actions():
+        snapshot = await get_info(charid)
+        await send(json.dumps(["s", snapshot.get("elements", {})]))
+        while True:
+            await send(await handle_frame(charid, await websocket.receive_text()))
+
+    tasks = [asyncio.create_task(push_events()), asyncio.create_task(handle_actions())]
+    try:
+        # Either side ending (disconnect, dropped stream) ends the session
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        hub.unsubscribe(queue)
+
+def _argument(cast, value):
+    # Only JSON numbers; int("5") or int(True) would let anything through
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(value)
+    return cast(value)
+
+async def handle_frame(charid: int, text: str) -> str:
+    """Run one client frame and return the reply frame"""
+    try:
+        frame = json.loads(text)
+    except ValueError:
+        return json.dumps(["x", "Malformed frame"])
+    if not isinstance(frame, list) or len(frame) < 2 or not isinstance(frame[0], str):
+        return json.dumps(["x", "Malformed frame"])
+    op, seq, *args = frame
+
+    if op == "g":
+        try:
+            radius = _argument(float, args[0]) if args else DEFAULT_VIEW_RADIUS
+        except (ValueError, TypeError):
+            return json.dumps(["r", seq, False, "Bad arguments"])
+        result = await get_info(charid, radius)
+        return json.dumps(["r", seq, result["status"], result.get("elements")])
+
+    if op not in ACTIONS:
+        return json.dumps(["x", f"Unknown op {op!r}"])
+    handler, types = ACTIONS[op]
+    try:
+        if len(args) != len(types):
+            raise ValueError
+        params = [_argument(cast, value) for cast, value in zip(types, args)]
+    except (ValueError, TypeError, OverflowError):
+        return json.dumps(["r", seq, False, "Bad arguments"])
+    return json.dumps(["r", seq, await handler(charid, *params)])
@@ -0,0 +1,34 @@
+"""Partitioning of the simulation by instance.
+
+Instances are spread over SIM_SHARDS shards (instance id modulo the shard
+count; characters without an instance go to shard 0). Every shard has its
+own action queues and its own tick owner (see leader.py), so several
+processes can each simulate a share of the instances and the world tick is
+no longer bound to one core. SIM_SHARDS must be the same for every process.
+
+Two groups of keys carry Redis Cluster hash tags and so share a slot: an
+instance's own keys (``instance:{id}``, its cell, member and empty_since
+keys) and a shard's queues, lease and fencing token (``{shard:n}:...``).
+Entity hashes (``char:``, ``npc:``, ``object:``) and the global sets
+(``dirty:*``, ``loaded_instances``, ...) carry no tag and land anywhere.
+Only TAKE_BATCH, TAKE_INTENTS and the lease scripts stick to the keys they
+declare; RECORD_INTENT, ENQUEUE_ACTION, PLACE, NEARBY, REPLICATE,
+SET_OBJECT_STATES and EVICT_INSTANCE build keys of both kinds inside the
+script, so this still needs a single Redis, not a cluster.
+"""
+import os
+
+SIM_SHARDS = int(os.getenv("SIM_SHARDS", "1"))
+
+def shard_of(instance, shards: int = SIM_SHARDS) -> int:
+    try:
+        return int(instance) % shards
+    except (TypeError, ValueError):
+        return 0
+
+def shard_key(shard: int, name: str) -> str:
+    return f"{{shard:{shard}}}:{name}"
+
+def instance_key(instance, suffix: str = "") -> str:
+    key = f"instance:{{{instance}}}"
+    return f"{key}:{suffix}" if suffix else key
@@ -1,9 +1,25 @@
 #!/usr/bin/env python3
+"""Game client simulator.
+
+    python simulate_client.py            scripted two-player walkthrough
+    python simulate_client.py load ...   asyncio mass load test (see --help)
+
+The load test needs httpx; --in-process additionally needs uvicorn and
+fakeredis[lua], and runs the whole server inside this process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
 import requests
 import time
 from threading import Thread, Event
 from queue import Queue
 from urllib.parse import urljoin
+from typing import Optional
 
 class GameSimulator:
     def __init__(self, base_url="http://localhost:8000"):
@@ -195,7 +211,241 @@ class GameSimulator:
             self.session.close()
             print("✅ Simulation complete")
 
+# Load Testing
+ENDPOINTS = ("login", "move", "attack", "interact", "get_info")
+
+def percentile(sorted_values, p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(values) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p95_ms": percentile(values, 95),
+        "p99_ms": percentile(values, 99),
+        "max_ms": values[-1] if values else None,
+    }
+
+def start_delay(profile: str, index: int, players: int, ramp_up: float) -> float:
+    """When virtual player number `index` joins, in seconds from the start"""
+    if profile == "spike" or ramp_up <= 0:
+        return 0.0
+    if profile == "step":
+        steps = 5
+        return ramp_up * (index * steps // players) / steps
+    return ramp_up * index / players  # linear
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.mix = {}
+        for part in args.mix.split(","):
+            name, weight = part.split("=")
+            if name not in ENDPOINTS:
+                raise ValueError(f"Unknown endpoint in mix: {name}")
+            self.mix[name] = float(weight)
+        self.latencies = {name: [] for name in ENDPOINTS}
+        self.errors = {name: 0 for name in ENDPOINTS}
+        self.event_delays = []
+        self.events_received = 0
+        self.charids = []
+        self.object_ids = set()
+        self.pending = {}  # (kind, charid) -> time the action was sent
+        self.stop = asyncio.Event()
+
+    async def request(self, client, endpoint: str, path: str, params=None):
+        start = time.perf_counter()
+        try:
+            response = await client.post(path, params=params)
+            ok = response.status_code == 200
+        except Exception:
+            response, ok = None, False
+        elapsed = (time.perf_counter() - start) * 1000
+        self.latencies[endpoint].append(elapsed)
+        if not ok:
+            self.errors[endpoint] += 1
+        return response if ok else None
+
+    async def create_player(self, client, index: int) -> Optional[int]:
+        userid = f"load{self.args.run_id}-{index}"
+        await client.post(f"/account/{userid}")
+        response = await client.post("/character", params={
+            "userid": userid,
+            "charname": f"{userid}-char",
+            "instance": self.args.instance,
+            "x": random.uniform(0, self.args.spread),
+            "y": random.uniform(0, self.args.spread),
+        })
+        if response.status_code != 200:
+            return None
+        return response.json()["charid"]
+
+    async def listen(self, client, charid: int):
+        """Follow a character's event stream and time action -> event delivery"""
+        try:
+            async with client.stream("GET", f"/events/{charid}") as response:
+                kind = None
+                async for line in response.aiter_lines():
+                    if line.startswith("event:"):
+                        kind = line[6:].strip()
+                    elif line.startswith("data:"):
+                        self.events_received += 1
+                        event = json.loads(line[5:])
+                        if kind == "combat":
+                            # One frame per region and tick, naming every attacker
+                            actors = {a["attacker"] for hit in event["hits"] for a in hit["attackers"]}
+                        else:
+                            actors = {event.get("charid")}
+                        for actor in actors:
+                            sent = self.pending.pop((kind, actor), None)
+                            if sent is not None:
+                                self.event_delays.append((time.perf_counter() - sent) * 1000)
+                    if self.stop.is_set():
+                        return
+        except Exception:
+            pass
+
+    async def player(self, client, stream_client, index: int, charid: int):
+        await asyncio.sleep(start_delay(self.args.profile, index, self.args.players, self.args.ramp_up))
+        if await self.request(client, "login", f"/login/{charid}") is None:
+            return
+        listening = index < self.args.players * self.args.sse_fraction
+        if listening:
+            listener = asyncio.create_task(self.listen(stream_client, charid))
+
+        # Poisson arrivals so the players together hit the target rate
+        mean_interval = self.args.players / self.args.rate
+        names, weights = list(self.mix), list(self.mix.values())
+        while not self.stop.is_set():
+            await asyncio.sleep(random.expovariate(1 / mean_interval))
+            if self.stop.is_set():
+                break
+            action = random.choices(names, weights)[0]
+            if action == "move":
+                if listening:
+                    self.pending[("movement", charid)] = time.perf_counter()
+                await self.request(client, "move", f"/move/{charid}", {"dx": random.uniform(-1, 1), "dy": random.uniform(-1, 1)})
+            elif action == "attack":
+                if listening:
+                    self.pending[("combat", charid)] = time.perf_counter()
+                await self.request(client, "attack", f"/attack/{charid}", {"target_id": random.choice(self.charids)})
+            elif action == "interact" and self.object_ids:
+                await self.request(client, "interact", f"/interact/{charid}", {"object_id": random.choice(list(self.object_ids))})
+            elif action == "get_info":
+                response = await self.request(client, "get_info", f"/get_info/{charid}/")
+                if response is not None:
+                    self.object_ids.update(int(i) for i in response.json()["elements"]["items"])
+            elif action == "login":
+                await self.request(client, "login", f"/login/{charid}")
+
+        if listening:
+            listener.cancel()
+
+    async def run(self, base_url: str) -> dict:
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.args.connections, max_keepalive_connections=self.args.connections)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client, \
+                httpx.AsyncClient(base_url=base_url, timeout=None) as stream_client:
+            print(f"Creating {self.args.players} virtual players...", file=sys.stderr)
+            semaphore = asyncio.Semaphore(self.args.connections)
+
+            async def create(index):
+                async with semaphore:
+                    return await self.create_player(client, index)
+
+            self.charids = [c for c in await asyncio.gather(*(create(i) for i in range(self.args.players))) if c]
+            if not self.charids:
+                raise RuntimeError("No virtual players could be created")
+
+            print(f"Running for {self.args.duration}s ({self.args.profile} ramp-up over {self.args.ramp_up}s)...", file=sys.stderr)
+            start = time.perf_counter()
+            tasks = [
+                asyncio.create_task(self.player(client, stream_client, i, charid))
+                for i, charid in enumerate(self.charids)
+            ]
+            await asyncio.sleep(self.args.duration)
+            self.stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            elapsed = time.perf_counter() - start
+
+        endpoints = {}
+        for name in ENDPOINTS:
+            stats = summarize(self.latencies[name])
+            stats["errors"] = self.errors[name]
+            stats["error_rate"] = self.errors[name] / stats["count"] if stats["count"] else 0.0
+            stats["rps"] = stats["count"] / elapsed
+            endpoints[name] = stats
+        return {
+            "players": len(self.charids),
+            "duration_s": elapsed,
+            "target_rps": self.args.rate,
+            "achieved_rps": sum(len(v) for v in self.latencies.values()) / elapsed,
+            "endpoints": endpoints,
+            "events": {"received": self.events_received, "delivery_delay": summarize(self.event_delays)},
+        }
+
+async def run_in_process(load_test: LoadTest) -> dict:
+    """Serve the app from this process against an in-memory Redis"""
+    import fakeredis
+    import uvicorn
+
+    os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(), "world.db"))
+    import database
+    database._redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    import main
+
+    config = uvicorn.Config(main.app, host="127.0.0.1", port=load_test.args.port, log_level="warning")
+    server = uvicorn.Server(config)
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        return await load_test.run(f"http://127.0.0.1:{load_test.args.port}")
+    finally:
+        server.should_exit = True
+        await serving
+
+def load_main(argv):
+    parser = argparse.ArgumentParser(prog="simulate_client.py load", description="Asyncio mass load test")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--in-process", action="store_true", help="run the server in this process on fakeredis")
+    parser.add_argument("--port", type=int, default=8765, help="port for --in-process")
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=500.0, help="target requests/s across all players")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load after creating players")
+    parser.add_argument("--ramp-up", type=float, default=10.0)
+    parser.add_argument("--profile", choices=("linear", "step", "spike"), default="linear")
+    parser.add_argument("--mix", default="move=50,attack=20,interact=10,get_info=20")
+    parser.add_argument("--sse-fraction", type=float, default=0.1, help="share of players following /events/{charid}")
+    parser.add_argument("--connections", type=int, default=200, help="HTTP connection pool size")
+    parser.add_argument("--instance", type=int, default=1)
+    parser.add_argument("--spread", type=float, default=100.0, help="players spawn within this square")
+    parser.add_argument("--run-id", default=str(int(time.time())))
+    parser.add_argument("--out", help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    load_test = LoadTest(args)
+    if args.in_process:
+        results = asyncio.run(run_in_process(load_test))
+    else:
+        results = asyncio.run(load_test.run(args.base_url))
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "load":
+        load_main(sys.argv[2:])
+        sys.exit(0)
     print("🎮 Starting game simulation")
     simulator = GameSimulator()
     simulator.run_simulation()
\ No newline at end of file
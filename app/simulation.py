@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Per-shard simulation, run by whichever process owns the shard.
+
+API workers campaign for shards at startup (unless RUN_SIMULATION=0), and
+this script adds simulation-only processes that serve no HTTP, to give the
+world tick more cores:
+
+    SIM_SHARDS=8 python simulation.py
+"""
+import asyncio
+import os
+from typing import Optional
+from database import get_redis, init_databases, close_sqlite
+from entities import drop_store
+from leader import start_elections, stop_elections
+from lib import instance_evictor
+from persistence import get_persister, close_persister
+from scheduler import TickScheduler
+from service import register_systems
+
+RUN_SIMULATION = os.getenv("RUN_SIMULATION", "1") != "0"
+
+async def game_loop(shard: int = 0, fence: Optional[int] = None):
+    """Run a shard's game ticks every TICK_INTERVAL (0.6) seconds"""
+    redis = await get_redis()
+    scheduler = TickScheduler(shard=shard, fence=fence)
+    register_systems(scheduler, shard)
+    await scheduler.run(redis)
+
+async def run_shard(shard: int, fence: int):
+    """Everything the owner of a shard runs, until it loses the lease"""
+    tasks = [asyncio.create_task(game_loop(shard, fence)), asyncio.create_task(instance_evictor(shard))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # The next owner reloads from the replica
+        drop_store(shard)
+
+async def main():
+    init_databases()
+    await get_persister()
+    await start_elections(run_shard)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_elections()
+        await close_persister()
+        close_sqlite()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""Uniform grid index over entity positions.
+
+Each instance is split into square cells of CELL_SIZE world units and every
+char:, npc: and object: key is a member of the set for the cell it stands in
+(``instance:{<id>}:cell:<cx>:<cy>``, the braces being a hash tag, see
+shards.py). Area-of-interest queries only visit the cells a view circle
+overlaps, so their cost follows local density rather than the number of
+entities in the instance.
+
+Events are published per region, a coarser block of REGION_SIZE units, on
+``{kind}:{instance}:{rx}:{ry}`` channels. A region is at least as wide as the
+view radius, so the 3x3 regions around a character cover its area of
+interest.
+"""
+import math
+from typing import Dict, List, Optional, Tuple, Any
+from scripts import run_script, PLACE, NEARBY
+from shards import instance_key
+from storage import LAYOUT
+
+CELL_SIZE = 32.0
+REGION_SIZE = CELL_SIZE * 4
+DEFAULT_VIEW_RADIUS = 100.0
+MAX_VIEW_RADIUS = 4 * DEFAULT_VIEW_RADIUS
+
+def cell_of(x: float, y: float) -> Tuple[int, int]:
+    return math.floor(x / CELL_SIZE), math.floor(y / CELL_SIZE)
+
+def cell_key(instance, cx: int, cy: int) -> str:
+    return instance_key(instance, f"cell:{cx}:{cy}")
+
+def region_of(x: float, y: float) -> Tuple[int, int]:
+    return math.floor(x / REGION_SIZE), math.floor(y / REGION_SIZE)
+
+def event_channel(kind: str, instance, x: float, y: float) -> str:
+    rx, ry = region_of(x, y)
+    return f"{kind}:{instance}:{rx}:{ry}"
+
+def regions_around(instance, x: float, y: float) -> List[Tuple[str, int, int]]:
+    """The 3x3 block of regions centred on the one containing x/y"""
+    rx, ry = region_of(x, y)
+    return [(str(instance), rx + i, ry + j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+async def place_entity(redis, key: str, fields: Dict[str, Any]):
+    """Write an entity hash (in the storage layout) and index it under the
+    cell of its x/y
+
+    Works with a pipeline as well, in which case the call is only queued.
+    """
+    args = [CELL_SIZE]
+    for field, value in LAYOUT.to_stored(fields).items():
+        args.extend((field, value))
+    return await run_script(redis, PLACE, keys=[key], args=args)
+
+async def entities_near(redis, charid: int, radius: float = DEFAULT_VIEW_RADIUS) -> Optional[Tuple[str, Dict[str, Dict[str, str]]]]:
+    """Return (instance, {key: fields}) for entities within radius of a character"""
+    # Clamped so a client can't make the script walk the whole instance
+    radius = min(max(radius, 0.0), MAX_VIEW_RADIUS)
+    found = await run_script(redis, NEARBY, keys=[f"char:{charid}"], args=[radius, CELL_SIZE])
+    if not found:
+        return None
+    instance, rest = found[0], found[1:]
+    entities = {}
+    for key, flat in zip(rest[::2], rest[1::2]):
+        entities[key] = LAYOUT.from_stored(dict(zip(flat[::2], flat[1::2])))
+    return instance, entities
@@ -0,0 +1,89 @@
+"""How entities are laid out in Redis.
+
+Characters, NPCs and objects are hashes (``char:<id>``, ``npc:<id>``,
+``object:<id>``); ENTITY_STORAGE picks their layout:
+
+- ``hash`` (default): full field names, values written as given, and the
+  world-wide membership sets online_chars, npcs and world_objects;
+- ``compact``: one-letter field names, coordinates rounded to
+  COORD_DECIMALS places, and no world-wide sets (the per-instance sets
+  already list every member, and nothing reads them). A hash stays far
+  inside Redis' hash-max-listpack-entries/-value limits, so it keeps the
+  small listpack encoding, and the sets, which turn into hashtables costing
+  tens of bytes per member past set-max-intset-entries, are gone.
+
+Code reading or writing entity hashes goes through the layout: field()
+names a field as stored (Lua scripts get them from lua_fields()),
+to_stored()/from_stored() convert whole records and membership_sets says
+whether to keep the world-wide sets. Every process must use the same
+layout, and switching means reloading the world from SQLite.
+memory_report.py measures both.
+"""
+import os
+from typing import Dict, Optional
+
+COORD_DECIMALS = 3
+
+def number(value: float):
+    # 90 rather than 90.0, like the values written by Lua
+    return int(value) if value.is_integer() else value
+
+class Layout:
+    def __init__(self, name: str, fields: Dict[str, str], coord_decimals: Optional[int] = None,
+                 membership_sets: bool = True):
+        self.name = name
+        self.fields = fields
+        self.names = {stored: field for field, stored in fields.items()}
+        self.coord_decimals = coord_decimals
+        self.membership_sets = membership_sets
+
+    def field(self, name: str) -> str:
+        return self.fields.get(name, name)
+
+    def value(self, name: str, value):
+        """A field's value as stored"""
+        if self.coord_decimals is not None and name in ("x", "y") and value not in (None, ""):
+            return number(round(float(value), self.coord_decimals))
+        return value
+
+    def to_stored(self, record: Dict) -> Dict:
+        return {self.field(name): self.value(name, value) for name, value in record.items()}
+
+    def from_stored(self, stored: Dict) -> Dict:
+        return {self.names.get(field, field): value for field, value in stored.items()}
+
+    def lua_fields(self) -> str:
+        """Lua table F of stored field names, e.g. F.health"""
+        return "local F = {" + ", ".join(f"{name} = '{stored}'" for name, stored in self.fields.items()) + "}\n"
+
+FIELDS = ("name", "x", "y", "health", "max_health", "instance", "state", "type")
+
+LAYOUTS = {
+    "hash": Layout("hash", {name: name for name in FIELDS}),
+    "compact": Layout("compact", {
+        "name": "n",
+        "x": "x",
+        "y": "y",
+        "health": "h",
+        "max_health": "m",
+        "instance": "i",
+        "state": "s",
+        "type": "t",
+    }, coord_decimals=COORD_DECIMALS, membership_sets=False),
+}
+
+def get_layout(name: str) -> Layout:
+    try:
+        return LAYOUTS[name]
+    except KeyError:
+        raise ValueError(f"Unknown entity storage {name!r}, expected one of {', '.join(LAYOUTS)}")
+
+LAYOUT = get_layout(os.getenv("ENTITY_STORAGE", "hash"))
+
+def stored_fields(*names: str) -> list:
+    """Stored names of the given fields, e.g. for HMGET"""
+    return [LAYOUT.field(name) for name in names]
+
+async def get_position(redis, key: str) -> list:
+    """[x, y, instance] of an entity as stored, Nones if it doesn't exist"""
+    return await redis.hmget(key, *stored_fields("x", "y", "instance"))